@@ -1,20 +1,118 @@
+import gzip
 import os
+import tempfile
+import uuid
 
-from flask import Flask, render_template, request, redirect, url_for, send_file, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, send_file, send_from_directory, session
 from flask_bootstrap import Bootstrap
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from utils import data_preparation, data_visualisation
+from utils import data_preparation, data_visualisation, reference_sets, track_export
+from utils.fragment_cache import DiskBackend, FragmentCache, MemoryBackend, ride_hash
+from utils.instrumentation import Metrics
+from utils.ride_library import PERIODS, RideLibrary
+from utils.ride_store import RideStore
+from utils.spatial_index import SpatialIndex
+from utils.upload_jobs import UploadJobs, UploadQueueFull
 
 #---------------------- FLASK ----------------------#
 app = Flask(__name__, template_folder=os.path.abspath("templates"), static_folder=os.path.abspath("static"))
 
 app.config["SECRET_KEY"] = "8BYkEfBA6O6donzWlSihBXox7C0sKR6b"
 app.config['SESSION_TYPE'] = 'filesystem'
+app.config['RIDE_STORE_DIR'] = os.environ.get('RIDE_STORE_DIR', os.path.join(tempfile.gettempdir(), 'cycling_dashboard_rides'))
+app.config['RIDE_STORE_MAX_BYTES'] = int(os.environ.get('RIDE_STORE_MAX_BYTES', 512 * 1024 ** 2))
+app.config['FRAGMENT_CACHE_BACKEND'] = os.environ.get('FRAGMENT_CACHE_BACKEND', 'memory')
+app.config['FRAGMENT_CACHE_DIR'] = os.environ.get('FRAGMENT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'cycling_dashboard_fragments'))
+app.config['FRAGMENT_CACHE_MAX_BYTES'] = int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES', 128 * 1024 ** 2))
+app.config['CHART_POINTS'] = int(os.environ.get('CHART_POINTS', data_visualisation.CHART_POINTS))
+app.config['DOWNSAMPLING_METHOD'] = os.environ.get('DOWNSAMPLING_METHOD', data_visualisation.DOWNSAMPLING_METHOD)
+app.config['WEBGL_THRESHOLD'] = int(os.environ.get('WEBGL_THRESHOLD', data_visualisation.WEBGL_THRESHOLD))
+app.config['FRAME_LAYOUT'] = os.environ.get('FRAME_LAYOUT', data_preparation.FRAME_LAYOUT)
+app.config['REFERENCE_DATA_DIR'] = os.environ.get('REFERENCE_DATA_DIR', reference_sets.DATA_DIR)
+app.config['RIDE_LIBRARY_DIR'] = os.environ.get('RIDE_LIBRARY_DIR')
+app.config['RIDE_LIBRARY_MANIFEST'] = os.environ.get('RIDE_LIBRARY_MANIFEST')
+app.config['RIDE_LIBRARY_INDEX_DIR'] = os.environ.get('RIDE_LIBRARY_INDEX_DIR')
+app.config['LIBRARY_SEARCH_MAX_RADIUS'] = float(os.environ.get('LIBRARY_SEARCH_MAX_RADIUS', 50_000))
+app.config['UPLOAD_JOBS_DIR'] = os.environ.get('UPLOAD_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'cycling_dashboard_uploads'))
+app.config['UPLOAD_WORKERS'] = int(os.environ.get('UPLOAD_WORKERS', 2))
+app.config['UPLOAD_MAX_PENDING'] = int(os.environ.get('UPLOAD_MAX_PENDING', 8))
+app.config['UPLOAD_DASH_WAIT'] = float(os.environ.get('UPLOAD_DASH_WAIT', 2.0))
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('UPLOAD_MAX_BYTES', 64 * 1024 ** 2))
+app.config['UPLOAD_MAX_UNCOMPRESSED_BYTES'] = int(os.environ.get('UPLOAD_MAX_UNCOMPRESSED_BYTES', 512 * 1024 ** 2))
+app.config['UPLOAD_MAX_POINTS'] = int(os.environ.get('UPLOAD_MAX_POINTS', 1_000_000))
+app.config['METRICS_ALLOW_REMOTE'] = os.environ.get('METRICS_ALLOW_REMOTE', '').lower() in ('1', 'true', 'yes')
 
 Bootstrap(app)
 
+data_visualisation.CHART_POINTS = app.config['CHART_POINTS']
+data_visualisation.DOWNSAMPLING_METHOD = app.config['DOWNSAMPLING_METHOD']
+data_visualisation.WEBGL_THRESHOLD = app.config['WEBGL_THRESHOLD']
+data_preparation.FRAME_LAYOUT = app.config['FRAME_LAYOUT']
+reference_sets.DATA_DIR = app.config['REFERENCE_DATA_DIR']
+
+metrics = Metrics()
+
+ride_store = RideStore(app.config['RIDE_STORE_DIR'], app.config['RIDE_STORE_MAX_BYTES'])
+upload_jobs = UploadJobs(
+    app.config['UPLOAD_JOBS_DIR'], ride_store, app.config['UPLOAD_WORKERS'], app.config['UPLOAD_MAX_PENDING'],
+    app.config['UPLOAD_MAX_POINTS'], app.config['UPLOAD_MAX_UNCOMPRESSED_BYTES'], metrics=metrics,
+)
+
+if app.config['FRAGMENT_CACHE_BACKEND'] == 'disk':
+    fragment_cache = FragmentCache(DiskBackend(app.config['FRAGMENT_CACHE_DIR'], app.config['FRAGMENT_CACHE_MAX_BYTES']), data_visualisation.render_settings)
+else:
+    fragment_cache = FragmentCache(MemoryBackend(app.config['FRAGMENT_CACHE_MAX_BYTES']), data_visualisation.render_settings)
+
+if app.config['RIDE_LIBRARY_DIR']:
+    ride_index = SpatialIndex(app.config['RIDE_LIBRARY_INDEX_DIR'] or os.path.join(app.config['RIDE_LIBRARY_DIR'], '.ride_index'))
+    ride_library = RideLibrary(app.config['RIDE_LIBRARY_DIR'], app.config['RIDE_LIBRARY_MANIFEST'], index=ride_index)
+    library_updates = ThreadPoolExecutor(max_workers=1)
+else:
+    ride_library = None
+
+
+def ride_key():
+    """
+    Returns the key the current session's ride is stored under
+    """
+    if 'ride_id' not in session:
+        session['ride_id'] = uuid.uuid4().hex
+    return session['ride_id']
+
+
+def store_ride(df):
+    """
+    Stores the prepared ride for the current session
+    """
+    session.pop('job_id', None)
+    metrics.call('store_ride', ride_store.put, ride_key(), df)
+
+
+def load_ride():
+    """
+    Returns the prepared ride of the current session, or None
+    """
+    return metrics.call('load_ride', ride_store.get, session.get('ride_id'))
+
+
+@app.before_request
+def start_timing():
+    metrics.start_request()
+
+
+@app.after_request
+def add_server_timing(response):
+    """
+    Reports the time spent in each stage of the request in a Server-Timing header
+    """
+    server_timing = metrics.finish_request(f"request:{request.endpoint or 'unmatched'}")
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+    return response
+
 @app.route('/')
 def index():
     """
@@ -25,63 +123,77 @@ def index():
     
     return render_template('index.html', footer_info=footer_info)
 
-uploaded_file_data = None
-
 @app.route('/dash', methods=['GET', 'POST'])
 def dash():
-    global uploaded_file_data
-    if not uploaded_file_data.empty:
-        df = uploaded_file_data
-        basic_info = data_preparation.basic_info(df)
+    job_id = session.get('job_id')
+    if job_id:
+        status = upload_jobs.wait(job_id, app.config['UPLOAD_DASH_WAIT'])
+        if status is not None and status['state'] != 'done':
+            if status['state'] == 'error':
+                # Shown once; the next /dash goes back to the session's stored ride
+                session.pop('job_id')
+            footer_info = [datetime.now().year]
+            return render_template('processing.html', job_id=job_id, status=status, footer_info=footer_info)
+        session.pop('job_id')
 
-        time = [basic_info[1].seconds // 3600, (basic_info[1].seconds % 3600) // 60]
-        basic_info[1] = time
-        
-        map_data = data_visualisation.plot_line_map(df)
-        chart_1 = data_visualisation.time_speed_graph(df)
-        chart_2 = data_visualisation.altitude_time_distance_speed_graph(df, 'distance')
+    df = load_ride()
+    if df is None:
+        return redirect(url_for('index'))
+
+    if not df.empty:
+        summary = metrics.call('ride_summary', data_preparation.ride_summary, df)
         
 
-        equator = data_preparation.closest_route(basic_info[0])
+        equator = metrics.call('closest_route', data_preparation.closest_route, round(summary.distance, 2))
         
-        closest_peak = data_preparation.closest_peak(basic_info[2])
-        ascent_percent = round((basic_info[2] / closest_peak[2]) * 100, 2)
-        closest_peak.append(ascent_percent)
+        total_ascent = round(summary.total_ascent, 2)
+        closest_peak = metrics.call('closest_peak', data_preparation.closest_peak, total_ascent)
+        if closest_peak:
+            ascent_percent = round((total_ascent / closest_peak[2]) * 100, 2)
+            closest_peak.append(ascent_percent)
         
-        animal_speed = data_preparation.find_faster_slower_animals(basic_info[8])
-        basic_info
+        animal_speed = metrics.call('find_faster_slower_animals', data_preparation.find_faster_slower_animals, round(summary.fastest_speed, 2))
         
         year = datetime.now().year
         footer_info = [year]
 
         
+        chart_1_args = (data_visualisation.time_speed_graph,)
+        chart_2_args = (data_visualisation.altitude_time_distance_speed_graph, 'distance')
+        
         if request.method == 'POST':
             if request.form['form_name'] == 'form1':
                 parameter1 = request.form.get('parameter1')
                 parameter2 = request.form.get('parameter2')
-                chart_1 = data_visualisation.create_custom_graph(df, parameter1, parameter2)
+                chart_1_args = (data_visualisation.create_custom_graph, parameter1, parameter2)
                 
             elif request.form['form_name'] == 'form2':
                 parameter = request.form.get('parameter')
-                chart_2 = data_visualisation.altitude_time_distance_speed_graph(df, parameter)
+                chart_2_args = (data_visualisation.altitude_time_distance_speed_graph, parameter)
+        
+        chart_1 = metrics.call(chart_1_args[0].__name__, fragment_cache.render, df, *chart_1_args)
+        chart_2 = metrics.call(chart_2_args[0].__name__, fragment_cache.render, df, *chart_2_args)
                 
-        graphical = [chart_1, map_data, chart_2]
+        graphical = [chart_1, chart_2]
         fun_stats = [equator, closest_peak, animal_speed]
             
     
-    return render_template('dashboard.html', basic_info=basic_info, graphical=graphical, fun_stats=fun_stats, footer_info=footer_info)
+    return metrics.call('render_dashboard', render_template, 'dashboard.html', summary=summary, graphical=graphical, fun_stats=fun_stats, footer_info=footer_info)
 
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    global uploaded_file_data
-
     if 'file' in request.files:
         file = request.files['file']
         if file.filename != '':
-            df = data_preparation.create_df(file)
-            data_preparation.prepare_df(df)
-            uploaded_file_data = df
+            try:
+                job_id = metrics.call('save_upload', upload_jobs.submit, file, ride_key())
+            except UploadQueueFull as error:
+                return str(error), 503, {'Retry-After': '5'}
+            session['job_id'] = job_id
+            
+            if request.accept_mimetypes.best == 'application/json':
+                return {'job_id': job_id, 'status': url_for('upload_status', job_id=job_id)}, 202
             return redirect(url_for('dash'))
     
     path_1 = 'sample_data/1.gpx'
@@ -91,30 +203,163 @@ def upload_file():
     if selected_radio_option:
 
         if selected_radio_option == 'option1':
-            df = data_preparation.create_prepare_df(path_1)
-            uploaded_file_data = df
+            df = metrics.call('create_prepare_df', data_preparation.create_prepare_df, path_1)
+            store_ride(df)
             pass
         elif selected_radio_option == 'option2':
-            df = data_preparation.create_prepare_df(path_2)
-            uploaded_file_data = df
+            df = metrics.call('create_prepare_df', data_preparation.create_prepare_df, path_2)
+            store_ride(df)
             pass
         elif selected_radio_option == 'option3':
-            df = data_preparation.create_prepare_df(path_3)
-            uploaded_file_data = df
+            df = metrics.call('create_prepare_df', data_preparation.create_prepare_df, path_3)
+            store_ride(df)
             pass    
         return redirect(url_for('dash'))
     
     return "No file or radio option selected"
 
+@app.errorhandler(413)
+def upload_too_large(error):
+    return f"File too large. Uploads are limited to {app.config['MAX_CONTENT_LENGTH'] // 1024 ** 2} MB.", 413
+
+
+@app.route('/upload/<job_id>')
+def upload_status(job_id):
+    """
+    State and progress of an upload being parsed and prepared
+    """
+    status = upload_jobs.status(job_id)
+    if status is None:
+        return {'error': 'Unknown upload'}, 404
+    return status
+
+
 @app.route('/iframe')
 def iframe():
-    global uploaded_file_data
-    if uploaded_file_data is not None:
-        map_html = data_visualisation.plot_line_map(uploaded_file_data)
+    """
+    Map page, rendered in the browser from /track
+    """
+    return render_template('iframe.html')
+
+
+TRACK_FORMATS = {
+    'geojson': (track_export.track_geojson, 'application/geo+json'),
+    'polyline': (track_export.track_polyline, 'application/json'),
+}
+
+@app.route('/track')
+def track():
+    """
+    The current ride's simplified track as GeoJSON (default) or ?format=polyline,
+    gzip compressed when accepted and revalidated with an ETag
+    """
+    df = load_ride()
+    if df is None:
+        return {'error': 'No ride uploaded'}, 404
+    
+    track_format = request.args.get('format', 'geojson')
+    if track_format not in TRACK_FORMATS:
+        return {'error': f"Unsupported format. Use one of: {', '.join(TRACK_FORMATS)}"}, 400
+    builder, mimetype = TRACK_FORMATS[track_format]
+    
+    etag = f'{ride_hash(df)}-{track_format}'
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    payload = metrics.call(builder.__name__, fragment_cache.render, df, builder).encode('utf-8')
+    response = app.response_class(mimetype=mimetype)
+    if 'gzip' in request.accept_encodings:
+        response.set_data(metrics.call('gzip_track', gzip.compress, payload, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
     else:
-        map_html = "<p>No data available</p>"
+        response.set_data(payload)
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def refresh_library():
+    """
+    Starts a background rescan of the ride library if it was never scanned or ?refresh=1
+    """
+    if not ride_library.scanned or request.args.get('refresh'):
+        ride_library.update_in_background(library_updates)
+
 
-    return render_template('iframe.html', map_html=map_html)
+@app.route('/library')
+def library():
+    """
+    Ride count, distance, ascent and moving hours per ?period=week|month|year over the
+    ride library folder. The folder is rescanned in the background the first time and
+    with ?refresh=1; 'updating' is true while a rescan runs.
+    """
+    if ride_library is None:
+        return {'error': 'No ride library configured. Set RIDE_LIBRARY_DIR.'}, 404
+
+    period = request.args.get('period', 'month')
+    if period not in PERIODS:
+        return {'error': f"Unsupported period. Use one of: {', '.join(PERIODS)}"}, 400
+
+    refresh_library()
+
+    totals = ride_library.totals(period)
+    return {
+        'period': period,
+        'totals': totals.reset_index().round(2).to_dict(orient='records'),
+        'errors': ride_library.errors(),
+        'updating': ride_library.updating,
+    }
+
+
+@app.route('/library/search')
+def library_search():
+    """
+    Rides in the library passing within ?radius= metres (default 200) of ?lat=&lon=,
+    or through ?bbox=min_lat,min_lon,max_lat,max_lon
+    """
+    if ride_library is None:
+        return {'error': 'No ride library configured. Set RIDE_LIBRARY_DIR.'}, 404
+
+    refresh_library()
+
+    try:
+        if 'bbox' in request.args:
+            min_lat, min_lon, max_lat, max_lon = (float(value) for value in request.args['bbox'].split(','))
+            if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lon <= max_lon <= 180):
+                raise ValueError('bbox outside the world or inverted')
+            return {'rides': ride_library.index.rides_in_bbox(min_lat, min_lon, max_lat, max_lon)}
+
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        radius = float(request.args.get('radius', 200))
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180 and 0 < radius <= app.config['LIBRARY_SEARCH_MAX_RADIUS']):
+            raise ValueError('point outside the world or radius out of range')
+    except (KeyError, ValueError):
+        return {'error': 'Give lat and lon (and optionally radius up to '
+                         f"{app.config['LIBRARY_SEARCH_MAX_RADIUS']:g} m), or bbox=min_lat,min_lon,max_lat,max_lon"}, 400
+
+    matches = ride_library.index.rides_near(lat, lon, radius)
+    return {'rides': [{'path': path, 'distance': round(distance, 1)} for path, distance in matches.items()]}
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Per-stage latency and payload size histograms and the fragment cache hits and misses
+    of this worker process, in the Prometheus text format. Only served to local requests
+    unless METRICS_ALLOW_REMOTE is set.
+    """
+    if not app.config['METRICS_ALLOW_REMOTE'] and request.remote_addr not in ('127.0.0.1', '::1'):
+        return 'Not found', 404
+    cache_stats = fragment_cache.stats()
+    counters = [
+        ('fragment_cache_hits_total', 'Charts and tracks served from the fragment cache.', cache_stats['hits']),
+        ('fragment_cache_misses_total', 'Charts and tracks rendered because they were not cached.', cache_stats['misses']),
+    ]
+    return metrics.render(counters=counters), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 
 @app.route('/temp/<path:filename>')
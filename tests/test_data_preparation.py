@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import data_preparation
+
+SAMPLE_RIDES = ['sample_data/1.gpx', 'sample_data/2.gpx', 'sample_data/3.gpx']
+
+
+def row_seg_speed(row, df):
+    """
+    The per-row segment speed prepare_df used before it was vectorized
+    """
+    if row.name == 0:
+        return float('NaN')
+
+    seconds = row['Time Difference'].total_seconds()
+    if seconds == 0:
+        return 0
+
+    distance_diff = row['Total Distance (M)'] - df.loc[row.name - 1, 'Total Distance (M)']
+
+    return (distance_diff / 1000) / (seconds / 3600)
+
+
+def row_prepare_df(df):
+    """
+    The per-row prepare_df the vectorized one replaced
+    """
+    df['Time'] = pd.to_datetime(df['Time'])
+    df['Time Difference'] = df['Time'].diff()
+    df['Altitude Difference'] = df['Altitude (M)'].diff()
+    df['Segment Speed'] = df.apply(row_seg_speed, axis=1, df=df)
+    df['Cumulative Time'] = df['Time Difference'].cumsum()
+    df['Total Time (M)'] = df['Cumulative Time'].dt.total_seconds() / 60
+    df.drop(columns=['Cumulative Time'], inplace=True)
+    return df
+
+
+def assert_prepared_equal(df):
+    expected = row_prepare_df(df.copy())
+    actual = data_preparation.prepare_df(df.copy())
+
+    assert list(actual.columns) == list(expected.columns)
+    for column in expected.columns:
+        pd.testing.assert_series_equal(actual[column], expected[column], check_dtype=False, rtol=1e-9)
+
+
+@pytest.fixture(autouse=True)
+def standard_layout(monkeypatch):
+    monkeypatch.setattr(data_preparation, 'FRAME_LAYOUT', 'standard')
+
+
+@pytest.mark.parametrize('path', SAMPLE_RIDES)
+def test_prepare_df_matches_row_implementation(path):
+    assert_prepared_equal(data_preparation.create_df(path))
+
+
+def test_prepare_df_matches_row_implementation_with_repeated_times():
+    times = pd.to_datetime(['2023-09-26 08:00:00', '2023-09-26 08:00:01', '2023-09-26 08:00:01',
+                            '2023-09-26 08:00:05', '2023-09-26 08:00:05', '2023-09-26 08:00:09'], utc=True)
+    df = pd.DataFrame({
+        'Time': times,
+        'Latitude': np.linspace(37.0, 37.001, len(times)),
+        'Longitude': np.linspace(-1.0, -1.001, len(times)),
+        'Altitude (M)': [10.0, 10.5, 10.5, 12.0, 11.0, 11.5],
+        'Total Distance (M)': [0.0, 4.0, 4.0, 20.0, 21.0, 40.0],
+    })
+    assert_prepared_equal(df)
+
+
+def test_seg_speed():
+    seconds = np.array([np.nan, 10.0, 0.0, 3600.0])
+    distances = np.array([0.0, 100.0, 150.0, 1150.0])
+
+    speed = data_preparation.seg_speed(seconds, distances)
+
+    assert np.isnan(speed[0])
+    assert speed[1:].tolist() == pytest.approx([36.0, 0.0, 1.0])
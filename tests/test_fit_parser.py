@@ -0,0 +1,147 @@
+import io
+import struct
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import data_preparation, fit_parser, synthetic_rides
+
+CRC_TABLE = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+             0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
+
+# (field number, size, base type) of the record messages written, and their struct formats
+RECORD_FIELDS = [(253, 4, 0x86), (0, 4, 0x85), (1, 4, 0x85), (2, 2, 0x84), (5, 4, 0x86)]
+HEART_RATE_FIELD = (3, 1, 0x02)
+
+
+def fit_crc(data):
+    crc = 0
+    for byte in data:
+        for nibble in (byte & 0x0F, byte >> 4):
+            tmp = CRC_TABLE[crc & 0x0F]
+            crc = (crc >> 4) & 0x0FFF
+            crc = crc ^ tmp ^ CRC_TABLE[nibble]
+    return crc
+
+
+def definition_message(local_type, endian, global_number, fields):
+    architecture = 1 if endian == '>' else 0
+    return (bytes([0x40 | local_type, 0, architecture]) + struct.pack(endian + 'H', global_number)
+            + bytes([len(fields)]) + b''.join(bytes(field) for field in fields))
+
+
+def encode_fit(ride, endian='<', heart_rate=True, compressed=False):
+    """
+    Encodes a ride (a dict of arrays as from synthetic_rides.generate_ride) as a FIT file:
+    a file_id message, then one record message per point and a lap message at the end of
+    every segment. With compressed, every other record uses a compressed timestamp header
+    instead of a timestamp field.
+    """
+    fields = RECORD_FIELDS + ([HEART_RATE_FIELD] if heart_rate else [])
+    record_format = endian + 'IiiHI' + ('B' if heart_rate else '')
+
+    body = definition_message(0, endian, 0, [(0, 1, 0x00), (4, 4, 0x86)])
+    body += bytes([0x00]) + struct.pack(endian + 'BI', 4, 0)
+    body += definition_message(1, endian, 20, fields)
+    body += definition_message(2, endian, 20, RECORD_FIELDS[1:])
+    body += definition_message(3, endian, 19, [(253, 4, 0x86), (2, 4, 0x86)])
+
+    times = ride['Time'].astype('datetime64[s]').astype(np.int64) - fit_parser.FIT_EPOCH_OFFSET
+    lap_start = times[0]
+    for i in range(len(times)):
+        if i and ride['Segment'][i] != ride['Segment'][i - 1]:
+            body += bytes([0x03]) + struct.pack(endian + 'II', int(times[i - 1]), int(lap_start))
+            lap_start = times[i]
+        latitude = int(round(ride['Latitude'][i] / fit_parser.SEMICIRCLES_TO_DEGREES))
+        longitude = int(round(ride['Longitude'][i] / fit_parser.SEMICIRCLES_TO_DEGREES))
+        altitude = int(round((ride['Altitude (M)'][i] + 500) * 5))
+        distance = int(round(ride['Total Distance (M)'][i] * 100))
+        if compressed and i % 2 and times[i] - times[i - 1] < 32:
+            body += bytes([0x80 | (2 << 5) | (int(times[i]) & 0x1F)])
+            body += struct.pack(endian + 'iiHI', latitude, longitude, altitude, distance)
+        else:
+            values = [int(times[i]), latitude, longitude, altitude, distance]
+            if heart_rate:
+                values.append(int(ride['Heart Rate (BPM)'][i]))
+            body += bytes([0x01]) + struct.pack(record_format, *values)
+    body += bytes([0x03]) + struct.pack(endian + 'II', int(times[-1]), int(lap_start))
+
+    header = struct.pack('<BBHI4s', 14, 0x20, 2132, len(body), b'.FIT')
+    header += struct.pack('<H', fit_crc(header))
+    return header + body + struct.pack('<H', fit_crc(header + body))
+
+
+@pytest.fixture
+def ride():
+    return synthetic_rides.generate_ride(2000, segments=3)
+
+
+def test_fit_ride_matches_the_same_ride_as_tcx(ride, tmp_path):
+    synthetic_rides.write_tcx(ride, tmp_path / 'ride.tcx')
+    (tmp_path / 'ride.fit').write_bytes(encode_fit(ride))
+
+    tcx = data_preparation.create_df_from_tcx(str(tmp_path / 'ride.tcx'))
+    fit = data_preparation.create_df_from_fit(str(tmp_path / 'ride.fit'))
+
+    assert list(fit.columns) == list(tcx.columns)
+    assert fit.dtypes.to_dict() == tcx.dtypes.to_dict()
+    pd.testing.assert_series_equal(fit['Time'], tcx['Time'])
+    # FIT stores positions in semicircles, altitude in 0.2 m and distance in cm
+    np.testing.assert_allclose(fit['Latitude'], tcx['Latitude'], atol=1e-7)
+    np.testing.assert_allclose(fit['Longitude'], tcx['Longitude'], atol=1e-7)
+    np.testing.assert_allclose(fit['Altitude (M)'], tcx['Altitude (M)'], atol=0.1)
+    np.testing.assert_allclose(fit['Total Distance (M)'], tcx['Total Distance (M)'], atol=0.005)
+    np.testing.assert_array_equal(fit['Heart Rate (BPM)'], tcx['Heart Rate (BPM)'])
+    np.testing.assert_array_equal(fit['Lap'], tcx['Lap'])
+    pd.testing.assert_frame_equal(data_preparation.lap_splits(data_preparation.prepare_df(fit)),
+                                  data_preparation.lap_splits(data_preparation.prepare_df(tcx)), atol=1e-4)
+
+
+def test_big_endian_and_compressed_timestamps_decode_the_same(ride):
+    expected = fit_parser.parse_fit(io.BytesIO(encode_fit(ride, heart_rate=False)))
+    columns = fit_parser.parse_fit(io.BytesIO(encode_fit(ride, endian='>', heart_rate=False, compressed=True)))
+
+    assert list(columns) == list(expected) == ['Time', 'Latitude', 'Longitude', 'Altitude (M)', 'Total Distance (M)', 'Lap']
+    pd.testing.assert_series_equal(columns['Time'], expected['Time'])
+    for column in ['Latitude', 'Longitude', 'Altitude (M)', 'Total Distance (M)', 'Lap']:
+        np.testing.assert_array_equal(columns[column], expected[column])
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100])
+def test_chunk_size_does_not_change_the_result(ride, chunk_size):
+    data = encode_fit(ride, compressed=True)
+    expected = fit_parser.parse_fit(io.BytesIO(data))
+    columns = fit_parser._parse_fit(fit_parser.ChunkedReader(io.BytesIO(data), chunk_size), None)
+
+    assert list(columns) == list(expected)
+    pd.testing.assert_series_equal(columns['Time'], expected['Time'])
+    for column in list(expected)[1:]:
+        np.testing.assert_array_equal(columns[column], expected[column])
+
+
+def test_invalid_heart_rate_is_missing(ride):
+    ride['Heart Rate (BPM)'][::10] = 0xFF
+
+    heart_rate = fit_parser.parse_fit(io.BytesIO(encode_fit(ride)))['Heart Rate (BPM)']
+
+    assert np.isnan(heart_rate[::10]).all()
+    assert not np.isnan(np.delete(heart_rate, np.s_[::10])).any()
+
+
+def test_rejects_bad_files(ride):
+    data = encode_fit(ride)
+
+    with pytest.raises(ValueError, match='Not a FIT file'):
+        fit_parser.parse_fit(io.BytesIO(b'<gpx></gpx>'))
+    with pytest.raises(ValueError, match='Truncated FIT file'):
+        fit_parser.parse_fit(io.BytesIO(data[:len(data) // 2]))
+    with pytest.raises(ValueError, match='more than 100 points'):
+        fit_parser.parse_fit(io.BytesIO(data), max_points=100)
+
+
+def test_records_after_each_lap_message_start_a_new_lap(ride):
+    laps = fit_parser.parse_fit(io.BytesIO(encode_fit(ride)))['Lap']
+
+    np.testing.assert_array_equal(laps, ride['Segment'])
+    assert laps.dtype == np.int32
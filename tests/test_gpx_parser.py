@@ -0,0 +1,102 @@
+import io
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import gpx_parser, synthetic_rides
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PEAK_RSS_SCRIPT = '''
+import sys
+import xml.etree.ElementTree as ET
+from utils import gpx_parser
+
+def peak_rss():
+    with open('/proc/self/status') as status:
+        return next(int(line.split()[1]) * 1024 for line in status if line.startswith('VmHWM:'))
+
+before = peak_rss()
+if sys.argv[2] == 'tree':
+    ET.parse(sys.argv[1])
+else:
+    gpx_parser.parse_gpx(sys.argv[1])
+print(peak_rss() - before)
+'''
+
+MULTI_TRACK_GPX = b'''<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="test" xmlns="http://www.topografix.com/GPX/1/1">
+ <trk>
+  <name>Morning</name>
+  <trkseg>
+   <trkpt lat="51.0" lon="-2.0"><ele>10.0</ele><time>2023-06-04T07:30:00Z</time></trkpt>
+   <trkpt lat="51.001" lon="-2.001"><ele>11.5</ele><time>2023-06-04T07:30:05Z</time></trkpt>
+  </trkseg>
+ </trk>
+ <trk>
+  <name>Afternoon</name>
+  <trkseg>
+   <trkpt lat="51.002" lon="-2.002"><time>2023-06-04T12:00:00Z</time></trkpt>
+  </trkseg>
+  <trkseg>
+   <trkpt lat="51.003" lon="-2.003"><ele>12.0</ele></trkpt>
+   <trkpt lat="51.004" lon="-2.004"><ele>13.0</ele><time>2023-06-04T12:00:10Z</time></trkpt>
+  </trkseg>
+ </trk>
+</gpx>
+'''
+
+
+def test_parse_gpx_reads_every_track_and_segment_in_order():
+    columns = gpx_parser.parse_gpx(io.BytesIO(MULTI_TRACK_GPX))
+
+    assert columns['Latitude'].tolist() == [51.0, 51.001, 51.002, 51.003, 51.004]
+    assert columns['Longitude'].tolist() == [-2.0, -2.001, -2.002, -2.003, -2.004]
+    np.testing.assert_array_equal(columns['Altitude (M)'], [10.0, 11.5, np.nan, 12.0, 13.0])
+    expected_times = pd.Series(pd.to_datetime(['2023-06-04T07:30:00', '2023-06-04T07:30:05', '2023-06-04T12:00:00',
+                                               None, '2023-06-04T12:00:10'], utc=True))
+    pd.testing.assert_series_equal(columns['Time'], expected_times, check_dtype=False)
+
+
+def test_parse_gpx_matches_the_written_ride_across_chunks(tmp_path):
+    ride = synthetic_rides.generate_ride(5000, segments=4)
+    path = tmp_path / 'ride.gpx'
+    synthetic_rides.write_gpx(ride, path)
+
+    columns = gpx_parser.parse_gpx(str(path), chunk_size=512)
+
+    np.testing.assert_array_equal(columns['Latitude'], ride['Latitude'])
+    np.testing.assert_array_equal(columns['Longitude'], ride['Longitude'])
+    np.testing.assert_array_equal(columns['Altitude (M)'], ride['Altitude (M)'])
+    np.testing.assert_array_equal(columns['Time'].dt.tz_localize(None).to_numpy(), ride['Time'].astype('datetime64[ns]'))
+
+
+def peak_rss_growth(path, parser):
+    """
+    Runs parser ('stream' or 'tree') on path in a fresh interpreter and returns how far
+    parsing raised its peak resident set size, in bytes. VmHWM is read rather than
+    ru_maxrss, which a child inherits from the process that forked it.
+    """
+    result = subprocess.run([sys.executable, '-c', PEAK_RSS_SCRIPT, str(path), parser],
+                            cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    return int(result.stdout)
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/status'), reason='needs /proc/self/status (Linux)')
+def test_parse_gpx_peak_rss_stays_near_the_file_size(tmp_path):
+    points = 200_000
+    path = tmp_path / 'long_ride.gpx'
+    synthetic_rides.write_gpx(synthetic_rides.generate_ride(points), path)
+    file_size = os.path.getsize(path)
+
+    streamed = peak_rss_growth(path, 'stream')
+    whole_tree = peak_rss_growth(path, 'tree')
+
+    # The four output columns take 32 bytes a point, about a third of the file;
+    # building the whole XML tree takes several times the file
+    assert streamed < 1.5 * file_size
+    assert whole_tree > 4 * file_size
@@ -0,0 +1,51 @@
+import os
+
+import pandas as pd
+import pytest
+
+from utils import synthetic_rides
+from utils.ride_store import RideStore, _ride_size
+
+
+@pytest.fixture
+def ride():
+    columns = synthetic_rides.generate_ride(5000)
+    return pd.DataFrame({column: columns[column] for column in ['Time', 'Latitude', 'Longitude', 'Altitude (M)', 'Total Distance (M)']})
+
+
+def ride_bytes(tmp_path, ride):
+    store = RideStore(str(tmp_path / 'measure'))
+    store.put('ride', ride)
+    return store.size()
+
+
+def test_running_total_matches_the_directory(tmp_path, ride):
+    store = RideStore(str(tmp_path / 'store'))
+    store.put('a', ride)
+    store.put('b', ride)
+    store.put('a', ride)
+    store.delete('b')
+
+    assert store.size() == _ride_size(os.path.join(store.directory, 'a'))
+    assert RideStore(store.directory).size() == store.size()
+
+
+def test_evicts_least_recently_used_rides_but_not_the_one_written(tmp_path, ride):
+    size = ride_bytes(tmp_path, ride)
+    store = RideStore(str(tmp_path / 'store'), max_bytes=int(size * 1.5))
+    store.put('a', ride)
+    os.utime(os.path.join(store.directory, 'a'), (1, 1))
+    store.put('b', ride)
+
+    assert store.get('a') is None
+    assert store.get('b') is not None
+    assert store.size() == size
+
+
+def test_refuses_a_ride_larger_than_the_store(tmp_path, ride):
+    store = RideStore(str(tmp_path / 'store'), max_bytes=ride_bytes(tmp_path, ride) // 2)
+
+    with pytest.raises(ValueError, match='more than'):
+        store.put('a', ride)
+    assert store.get('a') is None
+    assert store.size() == 0
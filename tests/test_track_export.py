@@ -0,0 +1,56 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import data_preparation, synthetic_rides, track_export
+
+
+@pytest.fixture
+def ride():
+    columns = synthetic_rides.generate_ride(3000)
+    df = pd.DataFrame({column: columns[column] for column in ['Time', 'Latitude', 'Longitude', 'Altitude (M)', 'Total Distance (M)']})
+    df['Time'] = df['Time'].astype('datetime64[ns]')
+    return data_preparation.prepare_df(df)
+
+
+def load_track(df):
+    return json.loads(track_export.track_geojson(df)), json.loads(track_export.track_polyline(df))
+
+
+def test_ride_without_altitude(ride):
+    ride['Altitude (M)'] = np.nan
+
+    feature, payload = load_track(ride)
+
+    assert all(len(position) == 2 for position in feature['geometry']['coordinates'])
+    assert payload['altitude'] is None
+
+
+def test_ride_without_positions(ride):
+    ride['Latitude'] = np.nan
+    ride['Longitude'] = np.nan
+
+    feature, payload = load_track(ride)
+
+    assert feature == {'type': 'FeatureCollection', 'features': []}
+    assert payload['polyline'] == '' and payload['markers'] == []
+
+
+def test_points_without_positions_are_left_out(ride):
+    ride.loc[100:200, ['Latitude', 'Longitude']] = np.nan
+    ride.loc[300:400, 'Altitude (M)'] = np.nan
+
+    vertices, markers = track_export.track_vertices(ride)
+    feature, _ = load_track(ride)
+
+    assert not np.isin(np.arange(100, 201), vertices).any()
+    assert len(feature['geometry']['coordinates']) == len(vertices)
+    assert max(markers) < len(vertices)
+
+
+def test_short_ride(ride):
+    feature, _ = load_track(ride.head(4).copy())
+
+    assert len(feature['geometry']['coordinates']) == 4
@@ -0,0 +1,198 @@
+"""
+Analyses every activity file under a directory in parallel and writes one summary row per ride.
+
+    python -m utils.batch DIRECTORY --output summary.csv [--parquet summary.parquet] [--comparisons fun_stats.csv] [--workers N]
+
+Rows are appended to the CSV as files finish, so an interrupted run picks up where it
+stopped when run again with the same output. --comparisons also writes the routes,
+peaks, climbs and animals every ride is compared against on the dashboard.
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import pandas as pd
+
+from utils import data_preparation, reference_sets
+
+EXTENSIONS = ('.gpx', '.tcx', '.fit', '.gpx.gz', '.tcx.gz', '.fit.gz')
+
+COLUMNS = [
+    'path', 'status', 'error', 'file_size', 'file_mtime', 'points', 'seconds',
+    'start_date', 'start_time', 'distance', 'moving_time', 'total_ascent', 'total_descent',
+    'altitude_change', 'lowest_altitude', 'highest_altitude', 'average_speed',
+    'fastest_speed', 'slowest_speed',
+]
+
+# (summary column, reference set, 'above' or 'below', output column)
+COMPARISONS = [
+    ('distance', 'routes', 'above', 'next_route'),
+    ('total_ascent', 'peaks', 'above', 'next_peak'),
+    ('total_ascent', 'climbs', 'above', 'next_climb'),
+    ('total_ascent', 'climbs', 'below', 'previous_climb'),
+    ('fastest_speed', 'animals', 'above', 'faster_animal'),
+    ('fastest_speed', 'animals', 'below', 'slower_animal'),
+]
+
+
+def find_activity_files(directory):
+    """
+    Returns the sorted paths of every activity file under directory
+    """
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def analyse_file(path):
+    """
+    Parses, prepares and summarises one activity file. Never raises: failures are
+    returned as a row with status 'error' and the exception message.
+    """
+    row = dict.fromkeys(COLUMNS)
+    row['path'] = path
+    started = time.perf_counter()
+    try:
+        stat = os.stat(path)
+        row['file_size'] = stat.st_size
+        row['file_mtime'] = stat.st_mtime
+
+        df = data_preparation.create_prepare_df(path)
+        summary = data_preparation.ride_summary(df)
+
+        row.update({
+            'status': 'ok',
+            'points': len(df),
+            'start_date': summary.start_date,
+            'start_time': summary.start_time,
+            'distance': summary.distance,
+            'moving_time': summary.moving_time.total_seconds(),
+            'total_ascent': summary.total_ascent,
+            'total_descent': summary.total_descent,
+            'altitude_change': summary.altitude_change,
+            'lowest_altitude': summary.lowest_altitude,
+            'highest_altitude': summary.highest_altitude,
+            'average_speed': summary.average_speed,
+            'fastest_speed': summary.fastest_speed,
+            'slowest_speed': summary.slowest_speed,
+        })
+    except Exception as error:
+        row['status'] = 'error'
+        row['error'] = ''.join(traceback.format_exception_only(type(error), error)).strip()
+    row['seconds'] = round(time.perf_counter() - started, 4)
+    return row
+
+
+def completed_paths(output, retry_errors=False):
+    """
+    Returns the paths already recorded in an existing summary CSV.
+    A retried file has several rows; the last one counts.
+    """
+    if not os.path.exists(output) or os.path.getsize(output) == 0:
+        return set()
+    done = pd.read_csv(output, usecols=['path', 'status']).drop_duplicates('path', keep='last')
+    if retry_errors:
+        done = done[done['status'] == 'ok']
+    return set(done['path'])
+
+
+def run_batch(directory, output, workers=None, parquet=None, retry_errors=False, report_every=100, log=sys.stderr, comparisons=None):
+    """
+    Analyses every activity file under directory that is not yet in output across a
+    process pool, appending one CSV row per file as it finishes.
+    Writes a Parquet copy of the whole summary to parquet, and the reference entries
+    every ride compares to to comparisons, when given.
+    Returns the number of files processed in this run.
+    """
+    paths = find_activity_files(directory)
+    done = completed_paths(output, retry_errors)
+    pending = [path for path in paths if path not in done]
+    print(f'{len(paths)} activity files, {len(paths) - len(pending)} already summarised, {len(pending)} to process', file=log)
+
+    write_header = not os.path.exists(output) or os.path.getsize(output) == 0
+    started = time.perf_counter()
+    files = points = errors = 0
+
+    with open(output, 'a', newline='') as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=COLUMNS)
+        if write_header:
+            writer.writeheader()
+
+        if pending:
+            with multiprocessing.Pool(workers) as pool:
+                for row in pool.imap_unordered(analyse_file, pending, chunksize=4):
+                    writer.writerow(row)
+                    output_file.flush()
+
+                    files += 1
+                    points += row['points'] or 0
+                    errors += row['status'] == 'error'
+                    if files % report_every == 0 or files == len(pending):
+                        elapsed = time.perf_counter() - started
+                        print(f'{files}/{len(pending)} files, {errors} errors, '
+                              f'{files / elapsed:.1f} files/s, {points / elapsed:,.0f} points/s', file=log)
+
+    if parquet:
+        write_parquet(output, parquet)
+    if comparisons:
+        write_comparisons(output, comparisons)
+    return files
+
+
+def write_parquet(csv_path, parquet_path):
+    """
+    Writes the latest row of every file in the summary CSV as a Parquet file.
+    Needs pyarrow or fastparquet installed.
+    """
+    summary = pd.read_csv(csv_path).drop_duplicates('path', keep='last')
+    try:
+        summary.to_parquet(parquet_path, index=False)
+    except ImportError as error:
+        raise RuntimeError('Parquet output needs pyarrow: pip install pyarrow') from error
+
+
+def compare_rides(summary):
+    """
+    Returns the nearest reference entries above or below the distance, ascent and fastest
+    speed of every ride in summary, with one batched lookup per comparison
+    """
+    comparisons = pd.DataFrame({'path': summary['path']})
+    for column, name, direction, output in COMPARISONS:
+        references = reference_sets.reference_set(name)
+        values = summary[column].to_numpy(dtype=float)
+        indices = references.above_indices(values) if direction == 'above' else references.below_indices(values)
+        comparisons[output] = references.take(indices, 'name')
+        comparisons[f'{output}_{references.key}'] = references.take(indices, references.key)
+    return comparisons
+
+
+def write_comparisons(csv_path, output_path):
+    """
+    Writes compare_rides() for the latest successful row of every file in the summary CSV
+    """
+    summary = pd.read_csv(csv_path).drop_duplicates('path', keep='last')
+    compare_rides(summary[summary['status'] == 'ok']).to_csv(output_path, index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarise every GPX/TCX/FIT file under a directory.')
+    parser.add_argument('directory', help='Directory to search for activity files')
+    parser.add_argument('--output', default='summary.csv', help='Summary CSV, appended to and resumed from')
+    parser.add_argument('--parquet', help='Also write the summary as this Parquet file')
+    parser.add_argument('--comparisons', help='Also write the routes, peaks, climbs and animals each ride compares to as this CSV')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--retry-errors', action='store_true', help='Process files that failed in earlier runs again')
+    args = parser.parse_args(argv)
+
+    run_batch(args.directory, args.output, args.workers, args.parquet, args.retry_errors, comparisons=args.comparisons)
+
+
+if __name__ == '__main__':
+    main()
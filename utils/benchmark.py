@@ -0,0 +1,170 @@
+"""
+Times and memory-profiles every stage of the pipeline on synthetic rides.
+
+    python -m utils.benchmark --output results.json [--baseline baseline.json] [--sizes 1000 10000] [--formats gpx tcx]
+
+Each stage is timed repeat times, keeping the fastest and median runs, then run once
+more under tracemalloc for its peak allocation. With --baseline, stages slower or
+hungrier than the baseline by more than --threshold are flagged and the exit code is 1.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from utils import data_preparation, data_visualisation, synthetic_rides, track_export
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+FORMATS = ['gpx', 'tcx']
+
+# Differences smaller than these are noise, whatever the ratio
+MIN_SECONDS = 0.005
+MIN_BYTES = 1024 ** 2
+
+
+def _basic_info(df):
+    data_preparation._ride_summaries.pop(id(df), None)
+    return data_preparation.basic_info(df)
+
+
+# name -> (function, whether it takes the prepared ride rather than the file path)
+STAGES = {
+    'create_df': (data_preparation.create_df, False),
+    'prepare_df': (lambda df: data_preparation.prepare_df(df.copy()), True),
+    'basic_info': (_basic_info, True),
+    'time_distance_graph': (data_visualisation.time_distance_graph, True),
+    'distance_altitude_graph': (data_visualisation.distance_altitude_graph, True),
+    'time_altitude_graph': (data_visualisation.time_altitude_graph, True),
+    'distance_speed_graph': (data_visualisation.distance_speed_graph, True),
+    'time_speed_graph': (data_visualisation.time_speed_graph, True),
+    'altitude_time_distance_speed_graph (time)': (lambda df: data_visualisation.altitude_time_distance_speed_graph(df, 'time'), True),
+    'altitude_time_distance_speed_graph (distance)': (lambda df: data_visualisation.altitude_time_distance_speed_graph(df, 'distance'), True),
+    'plot_line_map': (data_visualisation.plot_line_map, True),
+    'track_geojson': (track_export.track_geojson, True),
+}
+
+
+def synthetic_file(directory, points, file_format, seed=0):
+    """
+    Returns the path of a synthetic ride, generating it the first time
+    """
+    path = os.path.join(directory, f'synthetic-{points}.{file_format}')
+    if not os.path.exists(path):
+        synthetic_rides.WRITERS[file_format](synthetic_rides.generate_ride(points, seed), path)
+    return path
+
+
+def measure(function, argument, repeat):
+    """
+    Returns the fastest and median wall time of repeat calls, and the peak memory
+    allocated by one more call
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(argument)
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        function(argument)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'seconds': min(timings), 'median_seconds': statistics.median(timings), 'peak_bytes': peak}
+
+
+def run_benchmarks(sizes=SIZES, formats=FORMATS, repeat=3, directory=None, stages=None, log=sys.stderr):
+    """
+    Benchmarks every stage on a synthetic ride of every size and format.
+    Returns the results as a JSON-ready dict.
+    """
+    directory = directory or os.path.join(tempfile.gettempdir(), 'cycling_dashboard_benchmark')
+    os.makedirs(directory, exist_ok=True)
+    stages = stages or list(STAGES)
+
+    results = {}
+    for file_format in formats:
+        for points in sizes:
+            path = synthetic_file(directory, points, file_format)
+            df = data_preparation.create_prepare_df(path)
+            name = f'{file_format}-{points}'
+            results[name] = {'points': points, 'file_bytes': os.path.getsize(path), 'stages': {}}
+
+            for stage in stages:
+                function, prepared = STAGES[stage]
+                result = measure(function, df if prepared else path, repeat)
+                results[name]['stages'][stage] = result
+                print(f"{name:>12} {stage:<46} {result['seconds'] * 1000:10.1f} ms {result['peak_bytes'] / 1024 ** 2:10.1f} MB", file=log)
+
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+        },
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold=1.25):
+    """
+    Returns the stages that got slower or allocate more than threshold times the
+    baseline, as (ride, stage, metric, baseline value, current value)
+    """
+    regressions = []
+    for name, ride in results['results'].items():
+        baseline_stages = baseline.get('results', {}).get(name, {}).get('stages', {})
+        for stage, current in ride['stages'].items():
+            previous = baseline_stages.get(stage)
+            if previous is None:
+                continue
+            for metric, minimum in (('seconds', MIN_SECONDS), ('peak_bytes', MIN_BYTES)):
+                if current[metric] > previous[metric] * threshold and current[metric] - previous[metric] > minimum:
+                    regressions.append((name, stage, metric, previous[metric], current[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark every pipeline stage on synthetic rides.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Ride sizes in points')
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=FORMATS, help='File formats to generate')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), help='Stages to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage')
+    parser.add_argument('--directory', help='Where synthetic rides are generated and reused')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to write the results to')
+    parser.add_argument('--baseline', help='Earlier results to flag regressions against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Ratio to the baseline counted as a regression')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.formats, args.repeat, args.directory, args.stages)
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f'Results written to {args.output}', file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for name, stage, metric, previous, current in regressions:
+            print(f'REGRESSION {name} {stage} {metric}: {previous:.4g} -> {current:.4g} ({current / previous:.2f}x)', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print('No regressions against the baseline', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
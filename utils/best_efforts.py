@@ -0,0 +1,84 @@
+import numpy as np
+
+DEFAULT_EFFORTS = {
+    '6 points': ('points', 6),
+    '1 min': ('seconds', 60),
+    '5 min': ('seconds', 300),
+    '20 min': ('seconds', 1200),
+    '1 km': ('distance', 1000),
+    '10 km': ('distance', 10000),
+}
+
+
+def best_efforts(df, efforts=DEFAULT_EFFORTS):
+    """
+    Finds the fastest average speed in Km/h for every effort in a prepared ride.
+    Efforts map a name to a (kind, size) window where kind is 'points' (number
+    of points), 'seconds' (elapsed time) or 'distance' (metres covered).
+    Each point window takes O(n) with prefix sums; each seconds or distance window
+    takes O(n log n), a binary search for the end of the window from every point.
+    Returns a dict of name -> [speed, index of the middle of the window].
+    """
+    speeds = df['Segment Speed'].to_numpy(dtype=float)
+    distances = np.fmax.accumulate(np.nan_to_num(df['Total Distance (M)'].to_numpy(dtype=float)))
+    seconds = np.fmax.accumulate(np.nan_to_num(df['Total Time (M)'].to_numpy(dtype=float) * 60))
+
+    speed_sums = np.concatenate(([0.0], np.cumsum(np.nan_to_num(speeds))))
+    speed_counts = np.concatenate(([0], np.cumsum(~np.isnan(speeds))))
+
+    results = {}
+    for name, (kind, size) in efforts.items():
+        if kind == 'points':
+            results[name] = _best_points(speed_sums, speed_counts, size)
+        elif kind == 'seconds':
+            results[name] = _best_span(seconds, distances, seconds, size)
+        elif kind == 'distance':
+            results[name] = _best_span(distances, distances, seconds, size)
+        else:
+            raise ValueError(f"Unsupported effort kind '{kind}'. Use 'points', 'seconds' or 'distance'.")
+
+    return results
+
+
+def _best_points(speed_sums, speed_counts, window_size):
+    """
+    Mean segment speed over every window of window_size points, skipping missing speeds
+    """
+    starts = np.arange(len(speed_sums) - window_size)
+    totals = speed_sums[starts + window_size] - speed_sums[starts]
+    counts = speed_counts[starts + window_size] - speed_counts[starts]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        averages = totals / counts
+
+    return _peak(averages, starts + window_size // 2)
+
+
+def _best_span(axis, distances, seconds, size):
+    """
+    Average speed over every window spanning at least size along axis (seconds or metres),
+    finding each window's end by binary search on the non-decreasing axis
+    """
+    starts = np.arange(len(axis))
+    ends = np.searchsorted(axis, axis + size, side='left')
+    covered = ends < len(axis)
+    starts, ends = starts[covered], ends[covered]
+
+    elapsed = seconds[ends] - seconds[starts]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        averages = ((distances[ends] - distances[starts]) / 1000) / (elapsed / 3600)
+    averages[elapsed == 0] = np.nan
+
+    return _peak(averages, (starts + ends) // 2)
+
+
+def _peak(averages, centres):
+    """
+    Returns [highest average, its centre index], preferring the latest window on ties
+    """
+    if len(averages) == 0 or np.isnan(averages).all():
+        return [float('NaN'), None]
+
+    averages = np.where(np.isnan(averages), -np.inf, averages)
+    last = len(averages) - 1 - np.argmax(averages[::-1])
+    return [float(averages[last]), int(centres[last])]
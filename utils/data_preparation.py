@@ -1,9 +1,31 @@
-from math import radians, sin, cos, sqrt, atan2
+import contextlib
+import gzip
+import weakref
+
+import numpy as np
 import pandas as pd
-import xml.etree.ElementTree as ET
-import gpxpy
 
-import xml.etree.ElementTree as ET
+from utils import best_efforts, fit_parser, geodesy, gpx_parser, reference_sets, tcx_parser
+
+# 'standard' keeps every column at full precision. 'compact' stores coordinates,
+# altitudes and channels as float32 and drops the columns that can be derived
+# ('Total Distance (KM)', 'Time Difference'); read those with ride_column().
+# 'lazy' keeps only the parsed columns and returns a RideFrame that derives the
+# rest on first access.
+FRAME_LAYOUT = 'standard'
+LAYOUTS = ('standard', 'compact', 'lazy')
+
+COMPACT_DTYPES = {
+    'Latitude': np.float32,
+    'Longitude': np.float32,
+    'Altitude (M)': np.float32,
+    'Altitude Difference': np.float32,
+    'Segment Speed': np.float32,
+    'Heart Rate (BPM)': np.float32,
+    'Cadence (RPM)': np.float32,
+    'Power (W)': np.float32,
+}
+
 
 def create_prepare_df(path):
     df = create_df(path)
@@ -11,398 +33,529 @@ def create_prepare_df(path):
     return df
 
 
-def create_df(file: str) -> pd.DataFrame:
+def create_df(file: str, max_points=None, max_bytes=None) -> pd.DataFrame:
     """
-    Takes a file path and returns a Pandas DataFrame
+    Takes a file path or uploaded file and returns a Pandas DataFrame.
+    Gzipped files (.gpx.gz, .tcx.gz, .fit.gz) are decompressed while they are parsed.
+    Parsing stops with a ValueError once the ride has more than max_points points or
+    more than max_bytes of uncompressed data has been read.
     """
     if type(file) == str:
-        file_extension = file.split('.')[-1].lower()
-    else:
-        file_extension = file.filename.split('.')[-1].lower()
-    
-    if file_extension == 'tcx':
-        return create_df_from_tcx(file)
-    elif file_extension == 'gpx':
-        return create_df_from_gpx(file)
+        file_name = file.lower()
     else:
-        raise ValueError("Unsupported file format. Only TCX and GPX files are supported.")
+        file_name = file.filename.lower()
+
+    compressed = file_name.endswith('.gz')
+    if compressed:
+        file_name = file_name[:-3]
+    file_extension = file_name.split('.')[-1]
+
+    readers = {
+        'tcx': create_df_from_tcx,
+        'gpx': create_df_from_gpx,
+        'fit': create_df_from_fit,
+    }
+    if file_extension not in readers:
+        raise ValueError("Unsupported file format. Only TCX, GPX and FIT files are supported.")
+
+    with contextlib.ExitStack() as stack:
+        if compressed:
+            file = stack.enter_context(gzip.open(file, 'rb'))
+        if max_bytes is not None:
+            if type(file) == str:
+                file = stack.enter_context(open(file, 'rb'))
+            file = LimitedReader(file, max_bytes)
+        return readers[file_extension](file, max_points=max_points)
 
-def create_df_from_tcx(path):
+
+class LimitedReader:
     """
-    Takes a TCX file and returns a Pandas DataFrame
+    Read-only file wrapper that raises ValueError once more than max_bytes would be read
     """
-    tree = ET.parse(path)
-    root = tree.getroot()
-    
-    data = [
-        [
-            trackpoint.find('{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Time').text,
-            float(trackpoint.find('{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Position/{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}LatitudeDegrees').text),
-            float(trackpoint.find('{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Position/{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}LongitudeDegrees').text),
-            float(trackpoint.find('{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}AltitudeMeters').text),
-            float(trackpoint.find('{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}DistanceMeters').text),
-            float(float(trackpoint.find('{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}DistanceMeters').text) / 1000)
-        ]
-        for trackpoint in root.findall('.//{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Trackpoint')
-    ]
-
-    df = pd.DataFrame(data, columns=['Time', 'Latitude', 'Longitude', 'Altitude (M)', 'Total Distance (M)', 'Total Distance (KM)'])
+    def __init__(self, file, max_bytes):
+        self.file = file
+        self.max_bytes = max_bytes
+        self.position = 0
+
+    def read(self, size=-1):
+        remaining = self.max_bytes - self.position + 1
+        data = self.file.read(remaining if size is None or size < 0 else min(size, remaining))
+        self.position += len(data)
+        if self.position > self.max_bytes:
+            raise ValueError(f'Ride file is larger than {self.max_bytes} bytes.')
+        return data
+
+
+def create_df_from_tcx(path, position_gaps='interpolate', max_points=None):
+    """
+    Takes a TCX file and returns a Pandas DataFrame.
+    position_gaps sets how trackpoints without a position are handled: 'interpolate', 'drop' or 'keep'.
+    """
+    df = pd.DataFrame(tcx_parser.parse_tcx(path, max_points=max_points))
+    df = fill_position_gaps(df, position_gaps)
+    fill_distance(df)
+    df.insert(5, 'Total Distance (KM)', df['Total Distance (M)'] / 1000)
     return df
 
-def create_df_from_gpx(file):
+
+def create_df_from_gpx(file, max_points=None):
     """
     Takes a GPX file and returns a Pandas DataFrame
     """
-    if isinstance(file, str):
-        with open(file, 'r') as file_new:
-            df = create_df_from_gpx(file_new)
-    else:
-        gpx = gpxpy.parse(file)
-        
-        data = []
-        cumulative_distance = 0.0
-        prev_point = None
+    df = pd.DataFrame(gpx_parser.parse_gpx(file, max_points=max_points))
+
+    distances = geodesy.distances_3d(df['Latitude'], df['Longitude'], df['Altitude (M)'])
+    df['Total Distance (M)'] = geodesy.cumulative_distance(distances)
+    df['Total Distance (KM)'] = df['Total Distance (M)'] / 1000.0
+    return df
+
+
+def create_df_from_fit(file, max_points=None):
+    """
+    Takes a FIT file and returns a Pandas DataFrame
+    """
+    df = pd.DataFrame(fit_parser.parse_fit(file, max_points=max_points))
+    fill_distance(df)
+    df.insert(5, 'Total Distance (KM)', df['Total Distance (M)'] / 1000)
+    return df
+
+
+def fill_position_gaps(df, position_gaps='interpolate'):
+    """
+    Handles trackpoints without a position (indoor rides, GPS dropouts).
+    'interpolate' fills them linearly in time between the surrounding fixes,
+    'drop' removes them and 'keep' leaves them as NaN.
+    """
+    missing = (df['Latitude'].isna() | df['Longitude'].isna()).to_numpy()
+    if position_gaps == 'keep' or not missing.any() or missing.all():
+        return df
+    
+    if position_gaps == 'drop':
+        return df[~missing].reset_index(drop=True)
+    
+    if position_gaps == 'interpolate':
+        times = df['Time'].to_numpy(dtype='datetime64[ns]')
+        if np.isnat(times).any():
+            axis = np.arange(len(df), dtype=float)
+        else:
+            axis = times.astype(np.int64).astype(float)
         
-        for track in gpx.tracks:
-            for segment in track.segments:
-                segment_data = []
-                for point in segment.points:
-                    time = point.time
-                    lat = point.latitude
-                    lon = point.longitude
-                    altitude = point.elevation
-
-                    if prev_point is not None:
-                        distance = point.distance_3d(prev_point)
-                        cumulative_distance += distance
-                    else:
-                        distance = 0.0
-
-                    segment_data.append([time, lat, lon, altitude, cumulative_distance, cumulative_distance / 1000.0])
-                    prev_point = point
-
-                data.extend(segment_data)
-
-        df = pd.DataFrame(data, columns=['Time', 'Latitude', 'Longitude', 'Altitude (M)', 'Total Distance (M)', 'Total Distance (KM)'])
+        for column in ['Latitude', 'Longitude']:
+            values = df[column].to_numpy(dtype=float)
+            df[column] = np.interp(axis, axis[~missing], values[~missing])
+        return df
+    
+    raise ValueError("Unsupported position_gaps option. Use 'interpolate', 'drop' or 'keep'.")
+
+
+def fill_distance(df):
+    """
+    Fills 'Total Distance (M)' when the device did not record it, from the positions
+    if no point has a distance, otherwise by carrying the last recorded distance forward
+    """
+    if df['Total Distance (M)'].isna().all():
+        distances = geodesy.distances_3d(df['Latitude'], df['Longitude'], df['Altitude (M)'])
+        df['Total Distance (M)'] = geodesy.cumulative_distance(np.nan_to_num(distances))
+    elif df['Total Distance (M)'].isna().any():
+        df['Total Distance (M)'] = df['Total Distance (M)'].ffill().fillna(0)
     return df
 # ----------------------------------------------------------------------------------------
 def prepare_df(df):
     df['Time'] = pd.to_datetime(df['Time'])
 
-    df['Time Difference'] = df['Time'].diff()
-    
-    df['Altitude Difference'] = df['Altitude (M)'].diff()
-    
-    df['Segment Speed'] = df.apply(seg_speed, axis=1, df=df)
-    
-    df['Cumulative Time'] = df['Time Difference'].cumsum()
-    
-    df['Total Time (M)'] = df['Cumulative Time'].dt.total_seconds() / 60
-    
-    df.drop(columns=['Cumulative Time', ], inplace=True)
-    
+    if FRAME_LAYOUT not in LAYOUTS:
+        raise ValueError(f"Unsupported frame layout '{FRAME_LAYOUT}'. Use one of: {', '.join(LAYOUTS)}.")
+    if FRAME_LAYOUT == 'lazy':
+        return RideFrame(df.drop(columns=[column for column in DERIVED_COLUMNS if column in df]))
+
+    for column in PREPARED_COLUMNS:
+        df[column] = DERIVED_COLUMNS[column][1](df)
+
+    if FRAME_LAYOUT == 'compact':
+        compact_df(df)
     return df
 
 
-def seg_speed(row, df):
+def compact_df(df):
     """
-    Calculates speed in KM/H for a segment
+    Narrows a prepared ride in place to the compact layout: float32 coordinates,
+    altitudes and channels, without the columns ride_column() can derive
     """
-    if row.name == 0:
-        return float('NaN')
-    
-    seconds = row['Time Difference'].total_seconds()
-    if seconds == 0:
-        return 0
-    
-    distance_diff = row['Total Distance (M)'] - df.loc[row.name - 1, 'Total Distance (M)']
-    
-    return (distance_diff / 1000) / (seconds / 3600)
+    df.drop(columns=[column for column in COMPACT_DERIVED if column in df], inplace=True)
+    for column, dtype in COMPACT_DTYPES.items():
+        if column in df and df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
 
-    
-def haversine(lat1, lon1, lat2, lon2):
+
+def _time_difference(df):
+    return pd.Series(calc_time_difference(df['Time'].to_numpy(dtype='datetime64[ns]')), index=df.index, name='Time Difference')
+
+
+def _segment_speed(df):
+    seconds = df['Time Difference'].to_numpy(dtype='timedelta64[ns]') / np.timedelta64(1, 's')
+    return pd.Series(seg_speed(seconds, df['Total Distance (M)'].to_numpy(dtype=float)), index=df.index, name='Segment Speed')
+
+
+def _total_time(df):
+    return pd.Series(cumulative_minutes(df['Time Difference'].to_numpy(dtype='timedelta64[ns]')), index=df.index, name='Total Time (M)')
+
+
+def _grade(df):
+    distance_diff = df['Total Distance (M)'].diff()
+    grade = df['Altitude Difference'] / distance_diff * 100
+    return grade.where(distance_diff != 0, 0).rename('Grade (%)')
+
+
+# Column -> (columns it is derived from, function of the ride), in dependency order
+DERIVED_COLUMNS = {
+    'Total Distance (KM)': (('Total Distance (M)',), lambda df: (df['Total Distance (M)'] / 1000).rename('Total Distance (KM)')),
+    'Time Difference': (('Time',), _time_difference),
+    'Altitude Difference': (('Altitude (M)',), lambda df: df['Altitude (M)'].diff().rename('Altitude Difference')),
+    'Segment Speed': (('Time Difference', 'Total Distance (M)'), _segment_speed),
+    'Total Time (M)': (('Time Difference',), _total_time),
+    'Grade (%)': (('Altitude Difference', 'Total Distance (M)'), _grade),
+}
+
+# Derived columns prepare_df stores in the standard layout, and those the compact layout drops
+PREPARED_COLUMNS = ('Time Difference', 'Altitude Difference', 'Segment Speed', 'Total Time (M)')
+COMPACT_DERIVED = ('Total Distance (KM)', 'Time Difference')
+
+
+class RideFrame:
     """
-    Calculates the distance between two points
+    A prepared ride that computes its derived columns on first access.
+    base holds the parsed columns; DERIVED_COLUMNS are computed from them when first
+    read and cached until a column they depend on is assigned with ride[column] = values
+    (changes made to base directly need an invalidate()). Reads like a prepared
+    DataFrame for the functions of this package; to_df() gives a real one.
     """
-    R = 6371
-    
-    lat1 = radians(lat1)
-    lon1 = radians(lon1)
-    lat2 = radians(lat2)
-    lon2 = radians(lon2)
-    
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    
-    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    def __init__(self, base):
+        self.base = base
+        self._derived = {}
+
+    def __getitem__(self, column):
+        if isinstance(column, list):
+            return pd.DataFrame({name: self[name] for name in column})
+        if column in self.base:
+            return self.base[column]
+        if column not in self._derived:
+            if column not in DERIVED_COLUMNS:
+                raise KeyError(column)
+            self._derived[column] = DERIVED_COLUMNS[column][1](self)
+        return self._derived[column]
+
+    def __setitem__(self, column, values):
+        self.base[column] = values
+        self.invalidate(column)
+
+    def __contains__(self, column):
+        return column in self.base or column in DERIVED_COLUMNS
+
+    def __len__(self):
+        return len(self.base)
+
+    def invalidate(self, column=None):
+        """
+        Drops the cached columns derived from column, or all of them
+        """
+        if column is None:
+            self._derived.clear()
+        else:
+            stale = {column}
+            for name, (dependencies, _) in DERIVED_COLUMNS.items():
+                if stale.intersection(dependencies):
+                    stale.add(name)
+                    self._derived.pop(name, None)
+        for cache in RIDE_CACHES:
+            cache.pop(id(self), None)
+
+    @property
+    def columns(self):
+        return pd.Index(list(self.base.columns) + [column for column in DERIVED_COLUMNS if column not in self.base])
+
+    @property
+    def index(self):
+        return self.base.index
+
+    @property
+    def empty(self):
+        return self.base.empty
+
+    @property
+    def iloc(self):
+        return _RowIndexer(self)
+
+    def items(self):
+        for column in self.columns:
+            yield column, self[column]
+
+    def copy(self):
+        return RideFrame(self.base.copy())
+
+    def cached_columns(self):
+        return list(self._derived)
+
+    def to_df(self):
+        """
+        Returns a new DataFrame of the ride with every derived column
+        """
+        return self.base.assign(**{column: self[column] for column in DERIVED_COLUMNS if column not in self.base})
+
+
+class _RowIndexer:
+    """
+    ride.iloc for a RideFrame: ride.iloc[rows] selects rows by position, and indexing the
+    selection by column reads only that column, e.g. ride.iloc[-1]['Total Time (M)']
+    """
+    def __init__(self, frame):
+        self._frame = frame
+
+    def __getitem__(self, rows):
+        return _Rows(self._frame, rows)
+
+
+class _Rows:
+    def __init__(self, frame, rows):
+        self._frame = frame
+        self._rows = rows
+
+    def __getitem__(self, column):
+        return self._frame[column].iloc[self._rows]
+
+    def __getattr__(self, column):
+        if column.startswith('_'):
+            raise AttributeError(column)
+        try:
+            return self[column]
+        except KeyError:
+            raise AttributeError(column) from None
+
+
+def ride_column(df, column):
+    """
+    Returns a column of a prepared ride, deriving it when the layout does not store it
+    """
+    if column in df:
+        return df[column]
+    if column in DERIVED_COLUMNS:
+        return DERIVED_COLUMNS[column][1](df)
+    raise KeyError(column)
+
+
+def bytes_per_point(df):
+    """
+    Returns the resident memory of a ride frame per trackpoint, index included
+    """
+    return df.memory_usage(deep=True, index=True).sum() / max(len(df), 1)
+
+
+def calc_time_difference(times):
+    """
+    Calculates the time between consecutive points, NaT for the first point
+    """
+    time_difference = np.empty(len(times), dtype='timedelta64[ns]')
+    time_difference[:1] = np.timedelta64('NaT')
+    time_difference[1:] = np.diff(times)
+    return time_difference
+
+
+def seg_speed(seconds, distances):
+    """
+    Calculates speed in KM/H for every segment
+    """
+    distance_diff = np.empty(len(distances))
+    distance_diff[:1] = np.nan
+    distance_diff[1:] = np.diff(distances)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = (distance_diff / 1000) / (seconds / 3600)
+    speed[seconds == 0] = 0
     
-    distance = R * c
-    return distance
+    return speed
+
 
+def cumulative_minutes(time_difference):
+    """
+    Calculates the elapsed time in minutes at every point, skipping missing times
+    """
+    missing = np.isnat(time_difference)
+    nanos = np.where(missing, 0, time_difference.view('i8'))
+    minutes = np.cumsum(nanos) / 1e9 / 60
+    minutes[missing] = np.nan
+    return minutes
+
+    
 def calc_total_distance(df):
     """
-    Calculates the total distance in the ride in Km.
+    Calculates the total distance in the ride in Km, from the prepared 'Total Distance (M)'
+    column so the summary agrees with the splits, resampling and charts
     """
-    total_distance = sum(haversine(df['Latitude'][i - 1], df['Longitude'][i - 1], df['Latitude'][i], df['Longitude'][i])
-                        for i in range(1, len(df))
-                        )
-    return total_distance
+    distances = df['Total Distance (M)'].to_numpy(dtype=float)
+    if np.isnan(distances).all():
+        return 0.0
+    return float(np.nanmax(distances)) / 1000
 
 def calc_moving_time(df):
     """
     Calculates the total time of the ride.
     """
-    return df['Time Difference'].sum()
+    return ride_column(df, 'Time Difference').sum()
 
 def elevation_info(df):
     """
     Calculates different information from Altitude
     """
-    total_ascent = df['Altitude Difference'][df['Altitude Difference'] > 0].sum()
-    total_descent = df['Altitude Difference'][df['Altitude Difference'] < 0].sum()
-    total_change = df['Altitude Difference'].sum()
-    lowest = df['Altitude (M)'].min()
-    highest = df['Altitude (M)'].max()
+    summary = ride_summary(df)
     
-    return total_ascent, total_descent, total_change, lowest, highest
+    return summary.total_ascent, summary.total_descent, summary.altitude_change, summary.lowest_altitude, summary.highest_altitude
 
 def highest_average_speed(df, window_size=6):
-    max_avg, max_avg_index = max(
-        (window['Segment Speed'].mean(), i + window_size // 2)
-        for i, window in enumerate((df.iloc[i:i + window_size] for i in range(len(df) - window_size + 1)))
-    )
-    return [max_avg, max_avg_index]
+    """
+    Returns the highest mean segment speed over window_size points and the index of its middle point
+    """
+    effort = f'{window_size} points'
+    return best_efforts.best_efforts(df, {effort: ('points', window_size)})[effort]
 
 def speed_info(df):
     """
     Calculates different information about Speed.
     """
-    average = calc_total_distance(df) / (calc_moving_time(df).total_seconds() / 3600)
-    fastest = highest_average_speed(df)[0]
-    slowest = df['Segment Speed'].min()
+    summary = ride_summary(df)
     
-    return average, fastest, slowest
+    return summary.average_speed, summary.fastest_speed, summary.slowest_speed
 
 def start_date_time(df):
     """
     Calculates the start date and time
     """
-    date_start_pre = df.iloc[0].Time
+    date_start_pre = df['Time'].iloc[0]
     
     start_date = date_start_pre.strftime("%d-%m-%Y")
     start_time = date_start_pre.strftime("%H:%M")
     
     return [start_date, start_time]
 
+class RideSummary:
+    """
+    Every metric shown about a prepared ride, computed in a single pass over its columns.
+    Use ride_summary(df) to get the memoized summary of a ride.
+    """
+    def __init__(self, df):
+        altitudes = df['Altitude (M)'].to_numpy(dtype=float)
+        altitude_diff = df['Altitude Difference'].to_numpy(dtype=float)
+        speeds = df['Segment Speed'].to_numpy(dtype=float)
+
+        self.distance = calc_total_distance(df)
+        self.moving_time = calc_moving_time(df)
+
+        self.total_ascent = altitude_diff[altitude_diff > 0].sum()
+        self.total_descent = altitude_diff[altitude_diff < 0].sum()
+        self.altitude_change = np.nansum(altitude_diff)
+        self.lowest_altitude = np.nanmin(altitudes)
+        self.highest_altitude = np.nanmax(altitudes)
+
+        self.average_speed = self.distance / (self.moving_time.total_seconds() / 3600)
+        self.fastest_speed, self.fastest_index = highest_average_speed(df)
+        self.slowest_speed = np.nanmin(speeds)
+
+        self.start_date, self.start_time = start_date_time(df)
+
+    @property
+    def moving_hours(self):
+        return int(self.moving_time.total_seconds()) // 3600
+
+    @property
+    def moving_minutes(self):
+        return (int(self.moving_time.total_seconds()) % 3600) // 60
+
+
+_ride_summaries = {}
+
+# Caches keyed by id() of a ride, dropped by RideFrame.invalidate(); other modules add theirs
+RIDE_CACHES = [_ride_summaries]
+
+def ride_summary(df):
+    """
+    Returns the RideSummary of a prepared ride, computing it on first use
+    """
+    key = id(df)
+    if key not in _ride_summaries:
+        _ride_summaries[key] = RideSummary(df)
+        weakref.finalize(df, _ride_summaries.pop, key, None)
+    return _ride_summaries[key]
+
 def basic_info(df):
     """
     Returns basic information about the ride.
     """
+    summary = ride_summary(df)
     
-    distance = round(calc_total_distance(df), 2)
-    moving_time = calc_moving_time(df)
-    total_ascent = round(elevation_info(df)[0], 2)
-    total_descent = elevation_info(df)[1]
-    altitude_change = round(elevation_info(df)[2], 2)
-    lowest_altitude = round(elevation_info(df)[3], 2)
-    highest_altitude = round(elevation_info(df)[4], 2)
-    average_speed = round(speed_info(df)[0], 2)
-    fastest_speed = round(speed_info(df)[1], 2)
-    slowest_speed = round(speed_info(df)[2], 2)
-    start_date = start_date_time(df)
+    distance = round(summary.distance, 2)
+    moving_time = summary.moving_time
+    total_ascent = round(summary.total_ascent, 2)
+    total_descent = summary.total_descent
+    altitude_change = round(summary.altitude_change, 2)
+    lowest_altitude = round(summary.lowest_altitude, 2)
+    highest_altitude = round(summary.highest_altitude, 2)
+    average_speed = round(summary.average_speed, 2)
+    fastest_speed = round(summary.fastest_speed, 2)
+    slowest_speed = round(summary.slowest_speed, 2)
+    start_date = [summary.start_date, summary.start_time]
     
     
     return [distance, moving_time, total_ascent, total_descent, altitude_change, lowest_altitude, highest_altitude, average_speed, fastest_speed, slowest_speed, start_date]
 
-def find_faster_slower_animals(speed):
-    animals = {
-        'mountain_goat': 45,
-        'cow': 40,
-        'greyhound': 70,
-        'cat': 48,
-        'japanese_macaque': 16,
-        'hippo': 30,
-        'pig': 17,
-        'alligator': 56,
-        'panda': 32,
-        'african_bush_elephant': 40,
-        'anaconda': 8,
-        'grey_squirrel': 20,
-        'giraffe': 52,
-        'grizzly_bear': 56,
-        'brown_bear': 35,
-        'house_mouse': 13,
-        'polar_bear': 30,
-        'cheetah': 120,
-        'snail': 0.0085,
-        'starfish': 0.000576,
-        'koala': 30,
-        'cockroach': 5.4,
-        'Bertie - Guiness fastest tortoise': 1.007,
-    }
+def lap_splits(df):
+    """
+    Returns the distance, time and average speed of every lap of a prepared ride.
+    Rides without laps are treated as a single lap.
+    """
+    laps = df['Lap'] if 'Lap' in df else pd.Series(0, index=df.index)
     
-    animal_images = {
-        'mountain_goat': '2',
-        'cow': '3',
-        'greyhound': '4',
-        'cat': '5',
-        'japanese_macaque': '6',
-        'hippo': '7',
-        'pig': '10',
-        'alligator': '8',
-        'panda': '25',
-        'african_bush_elephant': '1',
-        'anaconda': '9',
-        'grey_squirrel': '11',
-        'giraffe': '12',
-        'grizzly_bear': '13',
-        'brown_bear': '13',
-        'house_mouse': '15',
-        'polar_bear': '14',
-        'cheetah': '24',
-        'snail': '19',
-        'starfish': '20',
-        'koala': '21',
-        'cockroach': '22',
-        'Bertie - Guiness fastest tortoise': '23',
-    }
-
-    above_speed = 1000
-    above_animal = ''
-    below_speed = 0
-    below_animal = ''
-
-
-    for idx, (key, value) in enumerate(animals.items()):
-        if value > speed:
-            if above_speed > value:
-                above_speed = value
-                above_animal = key
-        elif value < speed:
-            if below_speed < value:
-                below_speed = value
-                below_animal = key
-
-        if idx == len(animals) -1:
-            animal_images[above_animal]
-            above_path = f'/static/images/{animal_images[above_animal]}.png'
-            below_path = f'/static/images/{animal_images[below_animal]}.png'
-            faster_animal = [above_animal, above_speed, above_path]
-            slower_animal = [below_animal, below_speed, below_path]
-
-    return [faster_animal, slower_animal]
-
-peaks = {
-    "Albania": ["Maja e Jezercës", 2694],
-    "Andorra": ["Coma Pedrosa", 2942],
-    "Austria": ["Grossglockner", 3798],
-    "Belarus": ["Dzerzhinskaya Mountain", 345],
-    "Belgium": ["Signal de Botrange", 694],
-    "Bosnia and Herzegovina": ["Maglić", 2386],
-    "Bulgaria": ["Musala", 2925],
-    "Croatia": ["Dinara", 1831],
-    "Cyprus": ["Mount Olympus", 1952],
-    "Czech Republic": ["Snezka", 1603],
-    "Denmark": ["Møllehøj", 170.86],
-    "Estonia": ["Suur Munamägi", 318],
-    "Finland": ["Halti", 1328],
-    "France": ["Mont Blanc", 4810],
-    "Germany": ["Zugspitze", 2962],
-    "Greece": ["Mount Olympus", 2917],
-    "Hungary": ["Kékes", 1014],
-    "Iceland": ["Hvannadalshnjúkur", 2110],
-    "Ireland": ["Carrauntoohil", 1039],
-    "Italy": ["Monte Bianco (Mont Blanc)", 4810],
-    "Latvia": ["Gaiziņkalns", 312],
-    "Liechtenstein": ["Grauspitz", 2599],
-    "Lithuania": ["Aukštojas", 294],
-    "Luxembourg": ["Burgplatz", 559],
-    "Malta": ["Ta' Dmejrek", 253],
-    "Moldova": ["Bălăneşti Hill", 429],
-    "Monaco": ["Chemins des Révoires", 162],
-    "Montenegro": ["Bobotov Kuk", 2523],
-    "Netherlands": ["Vaalserberg", 322.7],
-    "North Macedonia": ["Mount Korab", 2764],
-    "Norway": ["Galdhøpiggen", 2469],
-    "Poland": ["Rysy", 2503],
-    "Portugal": ["Serra da Estrela", 1993],
-    "Romania": ["Moldoveanu Peak", 2544],
-    "San Marino": ["Monte Titano", 739],
-    "Serbia": ["Midžor", 2169],
-    "Slovakia": ["Gerlachovský štít", 2655],
-    "Slovenia": ["Triglav", 2864],
-    "Spain": ["Mulhacén", 3479],
-    "Sweden": ["Kebnekaise", 2097],
-    "Switzerland": ["Dufourspitze", 4634],
-    "Ukraine": ["Hoverla", 2061],
-    "United Kingdom": ["Ben Nevis", 1345],
-    "Vatican City": ["Vatican Hill", 75],
-    "Morocco": ["Toubkal", 4167],
-    "Kenya": ["Mount Kenya", 5199],
-    "Nepal": ["Mount Everest", 8848],
-    "Pakistan": ["K2", 8611],
-    "United States": ["Denali (Mount McKinley)", 6190],
-    "Canada": ["Mount Logan", 5959],
-    "Australia": ["Mount Kosciuszko", 2228],
-    "Indonesia": ["Puncak Jaya (Carstensz Pyramid)", 4884],
-    "Argentina": ["Aconcagua", 6962],
-    "Chile": ["Ojos del Salado", 6887]
-}
-
+    end_distance = df['Total Distance (M)'].groupby(laps).max()
+    end_time = df['Total Time (M)'].fillna(0).groupby(laps).max()
+    
+    distance = end_distance.diff().fillna(end_distance.iloc[:1]) / 1000
+    time = end_time.diff().fillna(end_time.iloc[:1])
+    
+    splits = pd.DataFrame({'Distance (KM)': distance, 'Time (M)': time})
+    splits['Average Speed'] = splits['Distance (KM)'] / (splits['Time (M)'] / 60)
+    splits.index.name = 'Lap'
+    return splits
 
+def _animal(entry):
+    if entry is None:
+        return None
+    return [entry['name'], entry['speed'], f"/static/images/{entry['image']}.png"]
 
-def closest_peak(altitude, peaks=peaks):
-    closest_peak = None
-    closest_difference = float('inf')
+def find_faster_slower_animals(speed, animals=None):
+    """
+    Returns [name, speed, image path] of the next faster and the next slower animal,
+    None where there is none
+    """
+    animals = animals or reference_sets.reference_set('animals')
+    return [_animal(animals.next_above(speed)), _animal(animals.next_below(speed))]
 
-    for country, data in peaks.items():
-        peak_name, peak_altitude = data
-        if peak_altitude > altitude:
-            difference = peak_altitude - altitude
-            if difference < closest_difference:
-                closest_difference = difference
-                closest_peak = [country, peak_name, peak_altitude]
 
-    return closest_peak
+def closest_peak(altitude, peaks=None):
+    """
+    Returns [country, name, altitude] of the lowest peak higher than altitude, or None
+    """
+    peaks = peaks or reference_sets.reference_set('peaks')
+    peak = peaks.next_above(altitude)
+    if peak is None:
+        return None
+    return [peak['country'], peak['name'], peak['altitude']]
     
     
-routes = {
-    'Italy': [('Amalfi Coast Drive', 50), ('Stelvio Pass', 24.7)],
-    'France': [('Route 66', 2448), ('Trollstigen', 20)],
-    'USA': [('Pacific Coast Highway', 1470), ('Blue Ridge Parkway', 755)],
-    'Australia': [('Great Ocean Road', 243), ('Kangaroo Island Coastal Drive', 155)],
-    'Canada': [('Icefields Parkway', 232), ('Cabot Trail', 298)],
-    'Peru': [('Machu Picchu Inca Trail', 43)],
-    'Nepal': [('Everest Base Camp Trek', 130)],
-    'New Zealand': [('Milford Sound Road', 120)],
-    'Argentina': [('Ruta 40', 5221)],
-    'Scotland': [('North Coast 500', 516)],
-    'Spain': [('Camino de Santiago', 800)],
-    'Ireland': [('Wild Atlantic Way', 2500)],
-    'Norway': [('Norwegian Scenic Routes', 2300), ('Atlantic Road', 8)],
-    'Germany': [('Romantic Road', 350)],
-    'Switzerland': [('Grand Tour of Switzerland', 1600)],
-    'India': [('Manali-Leh Highway', 479)],
-    'Chile': [('Carretera Austral', 1240)],
-    'South Africa': [('Garden Route', 300)],
-    'China': [('Guoliang Tunnel Road', 1.2)],
-    'Vietnam': [('Hai Van Pass', 21)],
-    'Turkey': [('Cappadocia', 20)],
-    'Earth': [('Equator', 40075)]
-}
-
-def closest_route(distance, routes=routes):
-    closest_route = None
-    closest_difference = float('inf')
-
-    for country, data_list in routes.items():
-        for route_name, route_distance in data_list:
-            if route_distance > distance:
-                difference = route_distance - distance
-                if difference < closest_difference:
-                    closest_difference = difference
-                    percent = round((distance / route_distance) * 100, 2)
-                    closest_route = [country, route_name, route_distance, percent]
-
-    return closest_route
\ No newline at end of file
+def closest_route(distance, routes=None):
+    """
+    Returns [country, name, distance, percent ridden] of the shortest route longer
+    than distance, or None
+    """
+    routes = routes or reference_sets.reference_set('routes')
+    route = routes.next_above(distance)
+    if route is None:
+        return None
+    return [route['country'], route['name'], route['distance'], round((distance / route['distance']) * 100, 2)]
\ No newline at end of file
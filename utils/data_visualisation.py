@@ -1,20 +1,120 @@
+import base64
+import json
+import uuid
+
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from plotly.offline import plot
+from plotly.utils import PlotlyJSONEncoder
 import folium
 
-from utils import data_preparation
+from utils import data_preparation, downsampling, resampling, track_export
+
+# Every chart is downsampled to about CHART_POINTS points before plotting,
+# and drawn with WebGL instead of SVG when it still has more than WEBGL_THRESHOLD
+CHART_POINTS = 2000
+DOWNSAMPLING_METHOD = 'lttb'
+WEBGL_THRESHOLD = 5000
+
+# Speed charts average speed over buckets of this many seconds / metres
+SPEED_TIME_BUCKET = 30
+SPEED_DISTANCE_BUCKET = 100
+
+# Bump when a change to the charts should not serve fragments cached before it
+RENDER_VERSION = 1
+
+
+def render_settings():
+    """
+    Returns the settings and version rendered charts depend on besides the ride,
+    for keying cached fragments
+    """
+    return RENDER_VERSION, CHART_POINTS, DOWNSAMPLING_METHOD, WEBGL_THRESHOLD, SPEED_TIME_BUCKET, SPEED_DISTANCE_BUCKET
+
+
+def downsample(df, x, y, keep=(), columns=()):
+    """
+    Returns the rows of df to plot for y over x, as a DataFrame of x, y and columns,
+    with any of them derived when the frame layout does not store them
+    """
+    x_values = data_preparation.ride_column(df, x)
+    y_values = data_preparation.ride_column(df, y)
+    indices = downsampling.downsample_indices(x_values, y_values, CHART_POINTS, DOWNSAMPLING_METHOD, keep)
+
+    values = {x: x_values, y: y_values}
+    for column in columns:
+        values.setdefault(column, data_preparation.ride_column(df, column))
+    return pd.DataFrame({column: series.to_numpy()[indices] for column, series in values.items()}, index=df.index[indices])
+
+
+def scatter_trace(points):
+    """
+    Returns the plotly trace class to draw points with
+    """
+    return go.Scattergl if len(points) > WEBGL_THRESHOLD else go.Scatter
+
+
+# NumPy dtypes plotly.js can decode from base64 typed arrays
+TYPED_ARRAY_DTYPES = {
+    'float64': 'f8',
+    'float32': 'f4',
+    'int32': 'i4',
+    'int16': 'i2',
+    'int8': 'i1',
+    'uint32': 'u4',
+    'uint16': 'u2',
+    'uint8': 'u1',
+}
+
+
+def encode_typed_arrays(value):
+    """
+    Replaces numeric NumPy arrays in a figure dict with base64 typed array specs
+    """
+    if isinstance(value, dict):
+        return {key: encode_typed_arrays(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_typed_arrays(item) for item in value]
+    if isinstance(value, np.ndarray):
+        if value.dtype == np.int64 or value.dtype == np.uint64 or value.dtype == bool:
+            value = value.astype(np.float64)
+        dtype = TYPED_ARRAY_DTYPES.get(value.dtype.name)
+        if dtype is None:
+            return value.tolist()
+        spec = {'dtype': dtype, 'bdata': base64.b64encode(np.ascontiguousarray(value).tobytes()).decode('ascii')}
+        if value.ndim > 1:
+            spec['shape'] = ','.join(str(size) for size in value.shape)
+        return spec
+    return value
+
+
+def render_div(fig):
+    """
+    Renders a figure to an HTML div like plotly.offline.plot, with numeric data sent as base64 typed arrays
+    """
+    figure = fig.to_plotly_json()
+    div_id = str(uuid.uuid4())
+    data = json.dumps(encode_typed_arrays(figure['data']), cls=PlotlyJSONEncoder)
+    layout = json.dumps(figure.get('layout', {}), cls=PlotlyJSONEncoder)
+
+    return (
+        f'<div><div id="{div_id}" class="plotly-graph-div" style="height:100%; width:100%;"></div>'
+        f'<script type="text/javascript">window.PLOTLYENV=window.PLOTLYENV || {{}};'
+        f'if (document.getElementById("{div_id}")) {{Plotly.newPlot("{div_id}", {data}, {layout}, {{"responsive": true}})}};'
+        f'</script></div>'
+    )
+
 
 def time_distance_graph(df):    
     fig = go.Figure()
+    points = downsample(df, 'Total Time (M)', 'Total Distance (M)')
 
     fig.add_trace(
-        go.Scatter(x=df['Total Time (M)'], y=df['Total Distance (M)'],
+        scatter_trace(points)(x=points['Total Time (M)'], y=points['Total Distance (M)'],
                    line=dict(width=1, color='#6CE5E8'),
-                   hoverinfo='text',
-                   text=['Time={} min, Distance={} Km'.format(round(time, 1), round(distance / 1000, 2))
-                              for i, (time, distance) in enumerate(zip(df['Total Time (M)'], df['Total Distance (M)']))],
+                   customdata=points['Total Distance (M)'].to_numpy() / 1000,
+                   hovertemplate='Time=%{x:.1f} min, Distance=%{customdata:.2f} Km<extra></extra>',
                    mode='lines+markers',
                    textfont=dict(size=12)
                    )
@@ -60,18 +160,18 @@ def time_distance_graph(df):
         title_font=dict(color='white', size=12),
     )
 
-    plot_div = plot(fig, output_type='div', include_plotlyjs=False)
+    plot_div = render_div(fig)
     return plot_div
 
 def distance_altitude_graph(df):    
     fig = go.Figure()
+    points = downsample(df, 'Total Distance (M)', 'Altitude (M)')
 
     fig.add_trace(
-        go.Scatter(x=df['Total Distance (M)'], y=df['Altitude (M)'],
+        scatter_trace(points)(x=points['Total Distance (M)'], y=points['Altitude (M)'],
                    line=dict(width=1, color='#6CE5E8'),
-                   hoverinfo='text',
-                   text=['Distance={} Km, Altitude={} M'.format(round(distance / 1000, 2, ), round(altitude, 2))
-                              for i, (distance, altitude) in enumerate(zip(df['Total Distance (M)'], df['Altitude (M)']))],
+                   customdata=points['Total Distance (M)'].to_numpy() / 1000,
+                   hovertemplate='Distance=%{customdata:.2f} Km, Altitude=%{y:.2f} M<extra></extra>',
                    mode='lines+markers',
                    textfont=dict(size=12)
                    )
@@ -117,14 +217,15 @@ def distance_altitude_graph(df):
         )
     )
     
-    plot_div = plot(fig, output_type='div', include_plotlyjs=False)
+    plot_div = render_div(fig)
     return plot_div
 
 
 def time_altitude_graph(df):
     fig = go.Figure()
+    points = downsample(df, 'Total Time (M)', 'Altitude (M)')
 
-    fig.add_trace(go.Scatter(x=df['Total Time (M)'], y=df['Altitude (M)'], line=dict(width=1, color='#6CE5E8'), hoverinfo='text', text=['Time={} min, Altitude={} M'.format(round(time, 2), round(altitude, 2)) for time, altitude in zip(df['Total Time (M)'], df['Altitude (M)'])], mode='lines+markers', textfont=dict(size=10)))
+    fig.add_trace(scatter_trace(points)(x=points['Total Time (M)'], y=points['Altitude (M)'], line=dict(width=1, color='#6CE5E8'), hovertemplate='Time=%{x:.2f} min, Altitude=%{y:.2f} M<extra></extra>', mode='lines+markers', textfont=dict(size=10)))
 
     x_lims = df.iloc[-1]['Total Time (M)'] * 1.1
     y_lims = df['Altitude (M)'].max() * 1.1
@@ -139,7 +240,7 @@ def time_altitude_graph(df):
 
     fig.update_traces(hoverlabel=dict(bgcolor='#123C76', bordercolor='#123C76', font=dict(size=10, color='white'), namelength=-1))
 
-    plot_div = plot(fig, output_type='div', include_plotlyjs=False)
+    plot_div = render_div(fig)
     return plot_div
 
 
@@ -147,32 +248,18 @@ def time_altitude_graph(df):
 def distance_speed_graph(df):
     fig = go.Figure()
 
-    window_size = 6
-    num_windows = len(df) // window_size
-
-    avg_distances = []
-    avg_speeds = []
-
-    for i in range(num_windows):
-        start_idx = i * window_size
-        end_idx = (i + 1) * window_size
-
-        avg_distance = df['Total Distance (M)'].iloc[start_idx:end_idx].mean()
-        avg_speed = df['Segment Speed'].iloc[start_idx:end_idx].sum() / window_size
-
-        avg_distances.append(avg_distance)
-        avg_speeds.append(avg_speed)
-
-    averaged_data = pd.DataFrame({'Distance': avg_distances, 'Speed': avg_speeds})
+    resampled = resampling.resample(df, 'distance', SPEED_DISTANCE_BUCKET, channels=['Segment Speed'])
+    averaged_data = pd.DataFrame({'Distance': resampled['Total Distance (M)'], 'Speed': resampled['Segment Speed']})
+    averaged_data = downsample(averaged_data, 'Distance', 'Speed')
 
     
     fig.add_trace(
-        go.Scatter(x=averaged_data['Distance'], y=averaged_data['Speed'],
+        scatter_trace(averaged_data)(x=averaged_data['Distance'], y=averaged_data['Speed'],
                    mode='lines+markers',
                    marker=dict(size=4, color='#6CE5E8'),
                    name='Speed',
-                   hoverinfo='text',
-                   text=['Distance={:.2f} Km, Speed={:.2f} Km/h'.format(round(distance / 1000, 2), round(speed, 2)) for distance, speed in zip(avg_distances, avg_speeds)],
+                   customdata=averaged_data['Distance'].to_numpy() / 1000,
+                   hovertemplate='Distance=%{customdata:.2f} Km, Speed=%{y:.2f} Km/h<extra></extra>',
                    textfont=dict(size=12)
                    )
     )
@@ -192,7 +279,8 @@ def distance_speed_graph(df):
     fig.update_yaxes(range=[0, y_lims])
     
     
-    average_speed = data_preparation.speed_info(df)[0]
+    summary = data_preparation.ride_summary(df)
+    average_speed = summary.average_speed
     
     fig.add_shape(
         dict(
@@ -217,20 +305,16 @@ def distance_speed_graph(df):
                    )
         )
 
-    max_speed_value, ms_id = data_preparation.highest_average_speed(df)
+    max_speed_value, ms_id = summary.fastest_speed, summary.fastest_index
     max_speed_distance = df.iloc[ms_id]['Total Distance (M)']
-       
-    
-    max_speed_text = 'Highest Speed Obtained: Distance={} Km, Speed={} Km/h'.format(
-                       round(max_speed_distance / 1000, 2), round(max_speed_value, 2))
     
     
     fig.add_trace(
         go.Scatter(x=[max_speed_distance], y=[max_speed_value],
                    mode='markers',
                    marker=dict(size=12, color='#6CE5E8', symbol='diamond'),
-                   hoverinfo='text',
-                   text=max_speed_text,
+                   customdata=[max_speed_distance / 1000],
+                   hovertemplate='Highest Speed Obtained: Distance=%{customdata:.2f} Km, Speed=%{y:.2f} Km/h<extra></extra>',
                    name='Highest Speed',
                    textfont=dict(size=12)
                    )
@@ -271,54 +355,56 @@ def distance_speed_graph(df):
     )
     )
     
-    plot_div = plot(fig, output_type='div', include_plotlyjs=False)
+    plot_div = render_div(fig)
     return plot_div
 
 
 def time_speed_graph(df):
-    avg_times, avg_speeds = [], []
-
-    for i in range(0, len(df), 6):
-        avg_time = df['Total Time (M)'].iloc[i:i+6].mean()
-        avg_speed = df['Segment Speed'].iloc[i:i+6].sum() / 6
-        avg_times.append(avg_time)
-        avg_speeds.append(avg_speed)
-
-    averaged_data = pd.DataFrame({'Time': avg_times, 'Speed': avg_speeds})
-    max_time, max_speed = max(avg_times) * 1.01, df['Segment Speed'].max() * 1.1
-    avg_speed = data_preparation.speed_info(df)[0]
-    max_speed_value, ms_id = data_preparation.highest_average_speed(df)
+    resampled = resampling.resample(df, 'time', SPEED_TIME_BUCKET, channels=['Segment Speed'])
+    averaged_data = pd.DataFrame({'Time': resampled['Total Time (M)'], 'Speed': resampled['Segment Speed']})
+    averaged_data = downsample(averaged_data, 'Time', 'Speed')
+    max_time, max_speed = resampled['Total Time (M)'].max() * 1.01, df['Segment Speed'].max() * 1.1
+    summary = data_preparation.ride_summary(df)
+    avg_speed = summary.average_speed
+    max_speed_value, ms_id = summary.fastest_speed, summary.fastest_index
     max_speed_time = df.iloc[ms_id]['Total Time (M)']
-    max_speed_text = 'Highest Speed Obtained: Time={} min, Speed={} Km/h'.format(round(max_speed_time, 2), round(max_speed_value, 2))
 
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=averaged_data['Time'], y=averaged_data['Speed'], mode='lines+markers', marker=dict(size=4, color='#6CE5E8'), hoverinfo='text', text=['Time={} min, Speed={} Km/h'.format(round(time, 2), round(speed, 2)) for time, speed in zip(avg_times, avg_speeds)], textfont=dict(size=10), showlegend=False))
+    fig.add_trace(scatter_trace(averaged_data)(x=averaged_data['Time'], y=averaged_data['Speed'], mode='lines+markers', marker=dict(size=4, color='#6CE5E8'), hovertemplate='Time=%{x:.2f} min, Speed=%{y:.2f} Km/h<extra></extra>', textfont=dict(size=10), showlegend=False))
     fig.add_shape(dict(type='line', x0=0, x1=max_time, y0=avg_speed, y1=avg_speed, line=dict(color='#6CE5E8', width=2, dash='dash'), showlegend=False))
-    fig.add_trace(go.Scatter(x=[max_speed_time], y=[max_speed_value], mode='markers', marker=dict(size=10, color='#fff', symbol='diamond'), hoverinfo='text', text=[max_speed_text] * len(avg_times), showlegend=False))
+    fig.add_trace(go.Scatter(x=[max_speed_time], y=[max_speed_value], mode='markers', marker=dict(size=10, color='#fff', symbol='diamond'), hovertemplate='Highest Speed Obtained: Time=%{x:.2f} min, Speed=%{y:.2f} Km/h<extra></extra>', showlegend=False))
     
     fig.update_layout(plot_bgcolor='#0B2447', paper_bgcolor='#0B2447', xaxis=dict(showgrid=False, gridcolor='#6CE5E8', title_font=dict(color='white'), tickfont=dict(color='white')), yaxis=dict(showgrid=False, gridcolor='#6CE5E8', title_font=dict(color='white'), tickfont=dict(color='white')), title_text='Time - Speed', title_font=dict(color='white', size=12), margin=dict(l=10, r=20, t=25, b=10))
     fig.update_traces(hoverlabel=dict(bgcolor='#123C76', bordercolor='#123C76', font=dict(size=10, color='white'), namelength=-1))
     
-    return plot(fig, output_type='div', include_plotlyjs=False)
+    return render_div(fig)
 
 
 
-def plot_line_map(df):
-    latitudes = df['Latitude'].tolist()
-    longitudes = df['Longitude'].tolist()
-    distances = df['Total Distance (M)'].tolist()
-    altitudes = df['Altitude (M)'].tolist()
-    times = df['Total Time (M)'].tolist()
+def plot_line_map(df, tolerance=5.0, marker_budget=300):
+    """
+    Plots the route on a folium map. The line is simplified to within tolerance metres,
+    and tooltip markers are limited to marker_budget points spread by distance,
+    plus the highest point and the fastest section. The vertices and markers are those
+    of track_export.track_vertices(), so points without a position are left out.
+    """
+    latitudes = df['Latitude'].to_numpy(dtype=float)
+    longitudes = df['Longitude'].to_numpy(dtype=float)
+    distances = df['Total Distance (M)'].to_numpy(dtype=float)
+    altitudes = df['Altitude (M)'].to_numpy(dtype=float)
+    times = df['Total Time (M)'].to_numpy(dtype=float)
 
-    center_lat = sum(latitudes) / len(latitudes)
-    center_lon = sum(longitudes) / len(longitudes)
-    m = folium.Map(location=[center_lat, center_lon], zoom_start=10)
+    vertices, marker_positions = track_export.track_vertices(df, tolerance, marker_budget)
+    markers = vertices[marker_positions]
 
-    route_coordinates = list(zip(latitudes, longitudes))
-
-    folium.PolyLine(locations=route_coordinates, color='blue', weight=5, opacity=0.7).add_to(m)
+    if len(vertices):
+        m = folium.Map(location=[latitudes[vertices].mean(), longitudes[vertices].mean()], zoom_start=10)
+        route_coordinates = np.column_stack((latitudes[vertices], longitudes[vertices])).tolist()
+        folium.PolyLine(locations=route_coordinates, color='blue', weight=5, opacity=0.7).add_to(m)
+    else:
+        m = folium.Map(zoom_start=2)
 
-    for lat, lon, dist, alt, time in zip(latitudes, longitudes, distances, altitudes, times):
+    for lat, lon, dist, alt, time in zip(latitudes[markers], longitudes[markers], distances[markers], altitudes[markers], times[markers]):
         tooltip = folium.Tooltip(
             text=f"Distance: {round(dist / 1000, 2)} Km<br>Altitude: {round(alt, 1)} Metres, Time: {round(time, 1)} Minutes",
             style="font-size: 14px; background-color: #123C76; color: #FFFFFF;",
@@ -359,7 +445,11 @@ def altitude_time_distance_speed_graph(df, x_choice):
         x_title = 'Time'
         x_units = 'Mins'
     
-    fig = px.scatter(df, x=x_axis, y='Altitude (M)', color='Segment Speed', color_continuous_scale='Agsunset',
+    fastest_point = int(np.nanargmax(df['Segment Speed'])) if df['Segment Speed'].notna().any() else 0
+    points = downsample(df, x_axis, 'Altitude (M)', keep=[fastest_point], columns=['Segment Speed'])
+    
+    fig = px.scatter(points, x=x_axis, y='Altitude (M)', color='Segment Speed', color_continuous_scale='Agsunset',
+                     render_mode='webgl' if len(points) > WEBGL_THRESHOLD else 'svg',
                      hover_data=[x_axis, 'Altitude (M)', 'Segment Speed'],
                      labels={x_axis: f'{x_title} ({x_units})', 'Altitude (M)': 'Altitude (m)'},
                      title=f'{x_title} - Speed - Altitude')
@@ -403,7 +493,7 @@ def altitude_time_distance_speed_graph(df, x_choice):
         )
     )
     
-    plot_div = plot(fig, output_type='div', include_plotlyjs=False)
+    plot_div = render_div(fig)
     return plot_div
 
 
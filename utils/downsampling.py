@@ -0,0 +1,81 @@
+import numpy as np
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: picks threshold points that keep the visual shape of y over x.
+    Returns the sorted indices of the points kept.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.nan_to_num(x)
+    y_filled = np.where(np.isnan(y), np.nanmean(y) if not np.isnan(y).all() else 0, y)
+
+    edges = (np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+
+    starts, ends = edges[:-1], edges[1:]
+    next_ends = np.append(ends[1:], n)
+    sums_x = np.concatenate(([0.0], np.cumsum(x)))
+    sums_y = np.concatenate(([0.0], np.cumsum(y_filled)))
+    next_x = (sums_x[next_ends] - sums_x[ends]) / (next_ends - ends)
+    next_y = (sums_y[next_ends] - sums_y[ends]) / (next_ends - ends)
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for bucket, (start, end) in enumerate(zip(starts, ends)):
+        bucket_x = x[start:end]
+        bucket_y = y_filled[start:end]
+        areas = np.abs((x[a] - next_x[bucket]) * (bucket_y - y_filled[a]) - (x[a] - bucket_x) * (next_y[bucket] - y_filled[a]))
+        a = start + int(np.argmax(areas))
+        selected[bucket + 1] = a
+
+    return selected
+
+
+def min_max(x, y, threshold):
+    """
+    Keeps the lowest and highest point of y in each of threshold // 2 buckets.
+    Returns the sorted indices of the points kept.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    buckets = max(threshold // 2, 1)
+    if threshold >= n:
+        return np.arange(n)
+
+    bucket_ids = np.arange(n) * buckets // n
+    order = np.lexsort((np.where(np.isnan(y), -np.inf, y), bucket_ids))
+    firsts = np.searchsorted(bucket_ids[order], np.arange(buckets), side='left')
+    lasts = np.searchsorted(bucket_ids[order], np.arange(buckets), side='right') - 1
+
+    return np.unique(np.concatenate((order[firsts], order[lasts], [0, n - 1])))
+
+
+METHODS = {
+    'lttb': lttb,
+    'minmax': min_max,
+}
+
+
+def downsample_indices(x, y, threshold, method='lttb', keep=()):
+    """
+    Picks about threshold points to plot, always keeping the highest and lowest y and
+    any indices in keep. Returns the sorted indices of the points kept.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unsupported downsampling method '{method}'. Use one of: {', '.join(METHODS)}.")
+
+    y = np.asarray(y, dtype=np.float64)
+    indices = METHODS[method](x, y, threshold)
+    if len(indices) == len(y):
+        return indices
+
+    peaks = [] if np.isnan(y).all() else [np.nanargmax(y), np.nanargmin(y)]
+    return np.unique(np.concatenate((indices, np.asarray(peaks + list(keep), dtype=np.int64))))
@@ -0,0 +1,272 @@
+import struct
+
+import numpy as np
+import pandas as pd
+
+from utils.gpx_parser import ColumnBuffer
+
+# Seconds between the Unix epoch and the FIT epoch (1989-12-31 00:00:00 UTC)
+FIT_EPOCH_OFFSET = 631065600
+
+SEMICIRCLES_TO_DEGREES = 180 / 2 ** 31
+
+RECORD_MESSAGE = 20
+LAP_MESSAGE = 19
+
+# FIT files are decoded this many bytes at a time
+CHUNK_SIZE = 64 * 1024
+
+# Base type number (low 5 bits of the base type byte) -> struct format, invalid value
+BASE_TYPES = {
+    0: ('B', 0xFF),
+    1: ('b', 0x7F),
+    2: ('B', 0xFF),
+    3: ('h', 0x7FFF),
+    4: ('H', 0xFFFF),
+    5: ('i', 0x7FFFFFFF),
+    6: ('I', 0xFFFFFFFF),
+    8: ('f', None),
+    9: ('d', None),
+    10: ('B', 0x00),
+    11: ('H', 0x0000),
+    12: ('I', 0x00000000),
+    14: ('q', 0x7FFFFFFFFFFFFFFF),
+    15: ('Q', 0xFFFFFFFFFFFFFFFF),
+    16: ('Q', 0x0000000000000000),
+}
+
+# Record message field number -> column, scale, offset
+RECORD_FIELDS = {
+    253: ('Timestamp', 1, 0),
+    0: ('Latitude', 1 / SEMICIRCLES_TO_DEGREES, 0),
+    1: ('Longitude', 1 / SEMICIRCLES_TO_DEGREES, 0),
+    2: ('Altitude (M)', 5, 500),
+    78: ('Enhanced Altitude (M)', 5, 500),
+    5: ('Total Distance (M)', 100, 0),
+    3: ('Heart Rate (BPM)', 1, 0),
+    4: ('Cadence (RPM)', 1, 0),
+    7: ('Power (W)', 1, 0),
+}
+
+OPTIONAL_COLUMNS = ['Heart Rate (BPM)', 'Cadence (RPM)', 'Power (W)']
+
+
+class MessageDefinition:
+    """
+    Layout of a local message type, with a precompiled struct for its data messages
+    """
+    def __init__(self, global_number, endian, fields, developer_size):
+        self.global_number = global_number
+
+        formats = [endian]
+        self.columns = []
+        for number, size, base_type in fields:
+            fmt, invalid = BASE_TYPES.get(base_type & 0x1F, (None, None))
+            wanted = global_number == RECORD_MESSAGE and number in RECORD_FIELDS
+            if fmt is not None and struct.calcsize(fmt) == size:
+                formats.append(fmt)
+                if wanted:
+                    self.columns.append((len(formats) - 2, RECORD_FIELDS[number], invalid))
+            else:
+                formats.append(f'{size}s')
+
+        if developer_size:
+            formats.append(f'{developer_size}s')
+
+        self.struct = struct.Struct(''.join(formats))
+        self.size = self.struct.size
+
+
+class ChunkedReader:
+    """
+    Reads a binary file chunk_size bytes at a time, keeping only the unread part of the
+    current chunk. ensure() makes the next bytes available in data from position.
+    """
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.data = b''
+        self.position = 0
+        self.offset = 0
+
+    def ensure(self, size):
+        """
+        Returns whether size bytes are available from position, reading more if needed
+        """
+        if self.position + size <= len(self.data):
+            return True
+        chunks = [self.data[self.position:]]
+        available = len(chunks[0])
+        self.offset += self.position
+        while available < size:
+            chunk = self.file.read(max(self.chunk_size, size - available))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            available += len(chunk)
+        self.data = b''.join(chunks)
+        self.position = 0
+        return available >= size
+
+    def need(self, size):
+        if not self.ensure(size):
+            raise ValueError("Truncated FIT file.")
+
+    def tell(self):
+        return self.offset + self.position
+
+
+def parse_fit(file, max_points=None):
+    """
+    Decodes the record messages of a FIT file into column arrays, reading it in chunks.
+    Takes a file path or a file object. Raises ValueError as soon as the file has more
+    than max_points records. Returns a dict of column -> NumPy array
+    with 'Time', 'Latitude', 'Longitude', 'Altitude (M)' and, when recorded,
+    'Total Distance (M)', 'Heart Rate (BPM)', 'Cadence (RPM)' and 'Power (W)', and
+    'Lap', the index of the lap each record belongs to. A lap message is written when
+    its lap ends, so records are counted into the lap after the last lap message.
+    """
+    if isinstance(file, str):
+        with open(file, 'rb') as file_new:
+            return _parse_fit(ChunkedReader(file_new), max_points)
+    return _parse_fit(ChunkedReader(file), max_points)
+
+
+def _parse_fit(reader, max_points):
+    if not reader.ensure(12) or reader.data[8:12] != b'.FIT':
+        raise ValueError("Not a FIT file.")
+
+    header_size = reader.data[0]
+    data_size = struct.unpack_from('<I', reader.data, 4)[0]
+    end = header_size + data_size
+    reader.need(header_size)
+    reader.position = header_size
+
+    columns = {column: ColumnBuffer(np.float64, np.nan) for column, _, _ in RECORD_FIELDS.values()}
+    laps = ColumnBuffer(np.int32, -1)
+    lap = 0
+    definitions = {}
+    last_timestamp = None
+
+    while reader.tell() < end and reader.ensure(1):
+        record_header = reader.data[reader.position]
+        reader.position += 1
+
+        if record_header & 0x80:
+            # Compressed timestamp header
+            local_type = (record_header >> 5) & 0x03
+            time_offset = record_header & 0x1F
+            definition = definitions[local_type]
+            reader.need(definition.size)
+            values = definition.struct.unpack_from(reader.data, reader.position)
+            reader.position += definition.size
+            if definition.global_number == LAP_MESSAGE:
+                lap += 1
+            if last_timestamp is None:
+                continue
+            timestamp = (last_timestamp & ~0x1F) + time_offset
+            if time_offset < (last_timestamp & 0x1F):
+                timestamp += 0x20
+            last_timestamp = timestamp
+            _check_points(columns, definition, max_points)
+            if _add_record(columns, definition, values, timestamp) is not None:
+                laps.append(lap)
+            continue
+
+        local_type = record_header & 0x0F
+
+        if record_header & 0x40:
+            reader.need(5)
+            data, position = reader.data, reader.position
+            architecture = data[position + 1]
+            endian = '>' if architecture == 1 else '<'
+            global_number = struct.unpack_from(endian + 'H', data, position + 2)[0]
+            field_count = data[position + 4]
+            reader.position += 5
+
+            reader.need(3 * field_count + (1 if record_header & 0x20 else 0))
+            data, position = reader.data, reader.position
+            fields = [tuple(data[position + 3 * i:position + 3 * i + 3]) for i in range(field_count)]
+            reader.position += 3 * field_count
+
+            developer_size = 0
+            if record_header & 0x20:
+                developer_count = reader.data[reader.position]
+                reader.position += 1
+                reader.need(3 * developer_count)
+                data, position = reader.data, reader.position
+                developer_size = sum(data[position + 3 * i + 1] for i in range(developer_count))
+                reader.position += 3 * developer_count
+
+            definitions[local_type] = MessageDefinition(global_number, endian, fields, developer_size)
+            continue
+
+        definition = definitions[local_type]
+        reader.need(definition.size)
+        values = definition.struct.unpack_from(reader.data, reader.position)
+        reader.position += definition.size
+        if definition.global_number == RECORD_MESSAGE:
+            _check_points(columns, definition, max_points)
+            timestamp = _add_record(columns, definition, values)
+            laps.append(lap)
+            if timestamp is not None:
+                last_timestamp = timestamp
+        elif definition.global_number == LAP_MESSAGE:
+            lap += 1
+
+    return _to_arrays(columns, laps)
+
+
+def _check_points(columns, definition, max_points):
+    if max_points is not None and definition.global_number == RECORD_MESSAGE and len(columns['Timestamp']) == max_points:
+        raise ValueError(f'Ride has more than {max_points} points.')
+
+
+def _add_record(columns, definition, values, timestamp=None):
+    """
+    Appends one record message to the columns, NaN for fields it does not have.
+    Returns the record's timestamp in FIT seconds.
+    """
+    if definition.global_number != RECORD_MESSAGE:
+        return None
+
+    record = {}
+    for index, (column, scale, offset), invalid in definition.columns:
+        value = values[index]
+        if value != invalid:
+            record[column] = value / scale - offset
+
+    if 'Timestamp' in record:
+        timestamp = int(record['Timestamp'])
+    elif timestamp is not None:
+        record['Timestamp'] = timestamp
+
+    for column, buffer in columns.items():
+        buffer.append(record.get(column))
+
+    return timestamp
+
+
+def _to_arrays(columns, laps):
+    """
+    Converts the decoded columns to typed arrays, dropping optional channels that were never recorded
+    """
+    timestamps = columns.pop('Timestamp').to_array()
+    times = np.full(len(timestamps), np.datetime64('NaT'), dtype='datetime64[ns]')
+    recorded = ~np.isnan(timestamps)
+    times[recorded] = ((timestamps[recorded].astype(np.int64) + FIT_EPOCH_OFFSET) * 10 ** 9).astype('datetime64[ns]')
+
+    arrays = {column: buffer.to_array() for column, buffer in columns.items()}
+
+    enhanced_altitude = arrays.pop('Enhanced Altitude (M)')
+    arrays['Altitude (M)'] = np.where(np.isnan(enhanced_altitude), arrays['Altitude (M)'], enhanced_altitude)
+
+    result = {'Time': pd.Series(times).dt.tz_localize('UTC')}
+    for column in ['Latitude', 'Longitude', 'Altitude (M)', 'Total Distance (M)']:
+        result[column] = arrays[column]
+    for column in OPTIONAL_COLUMNS:
+        if not np.isnan(arrays[column]).all():
+            result[column] = arrays[column]
+    result['Lap'] = laps.to_array()
+
+    return result
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import pandas as pd
+
+from utils import data_preparation
+
+
+class MemoryBackend:
+    """
+    Keeps rendered fragments in process, evicting the least recently used past max_bytes
+    """
+    def __init__(self, max_bytes=64 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+            return fragment
+
+    def set(self, key, fragment):
+        size = len(fragment)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._fragments:
+                self.size -= len(self._fragments.pop(key))
+            self._fragments[key] = fragment
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._fragments.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class DiskBackend:
+    """
+    Keeps rendered fragments as files under directory, shared by every worker process,
+    evicting the least recently used past max_bytes
+    """
+    def __init__(self, directory, max_bytes=256 * 1024 ** 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.html')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as fragment_file:
+                fragment = fragment_file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return fragment
+
+    def set(self, key, fragment):
+        path = self._path(key)
+        staging = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(staging, 'w', encoding='utf-8') as fragment_file:
+            fragment_file.write(fragment)
+        os.replace(staging, path)
+        self.evict()
+
+    def evict(self):
+        fragments = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.html'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            fragments.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        for _, size, path in sorted(fragments):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_ride_hashes = {}
+data_preparation.RIDE_CACHES.append(_ride_hashes)
+
+def ride_hash(df):
+    """
+    Returns a hash of the contents of a ride, computed once per frame.
+    A RideFrame is hashed by its parsed columns, which its derived columns follow from.
+    """
+    key = id(df)
+    if key not in _ride_hashes:
+        frame = df.base if isinstance(df, data_preparation.RideFrame) else df
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr(list(frame.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(frame, index=False).to_numpy().tobytes())
+        _ride_hashes[key] = digest.hexdigest()
+        weakref.finalize(df, _ride_hashes.pop, key, None)
+    return _ride_hashes[key]
+
+
+class FragmentCache:
+    """
+    Caches rendered chart and map HTML by (ride contents, chart function, parameters,
+    render settings). settings is called for every lookup and returns the module
+    settings fragments depend on, so changing them does not serve stale fragments.
+    """
+    def __init__(self, backend, settings=None):
+        self.backend = backend
+        self.settings = settings
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def render(self, df, function, *args):
+        """
+        Returns function(df, *args), rendering it only if it is not cached yet
+        """
+        key = hashlib.blake2b(
+            f'{ride_hash(df)}|{function.__module__}.{function.__qualname__}|{args!r}|{self.settings() if self.settings else ()!r}'.encode(),
+            digest_size=16,
+        ).hexdigest()
+
+        fragment = self.backend.get(key)
+        if fragment is not None:
+            with self._lock:
+                self.hits += 1
+            return fragment
+
+        with self._lock:
+            self.misses += 1
+        fragment = function(df, *args)
+        if fragment is not None:
+            self.backend.set(key, fragment)
+        return fragment
+
+    def stats(self):
+        """
+        Returns the hit and miss counters of this process
+        """
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,73 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+
+# gpxpy's constants, kept so parsed distances match gpxpy's distance_3d
+GPX_EARTH_RADIUS_M = 6378137.0
+ONE_DEGREE_M = (2 * np.pi * GPX_EARTH_RADIUS_M) / 360
+
+
+def haversine(lat1, lon1, lat2, lon2, radius=EARTH_RADIUS_KM):
+    """
+    Calculates the distance between two arrays of points, in the units of radius (Km by default)
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(values, dtype=np.float64)) for values in (lat1, lon1, lat2, lon2))
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    return radius * c
+
+
+def distances_3d(latitudes, longitudes, elevations=None):
+    """
+    Calculates the distance in metres of every segment of a track, 0 for the first point.
+    Matches gpxpy's distance_3d: a flat approximation for close points, haversine otherwise.
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+
+    lat1, lat2 = latitudes[:-1], latitudes[1:]
+    lon1, lon2 = longitudes[:-1], longitudes[1:]
+
+    x = lat2 - lat1
+    y = (lon2 - lon1) * np.cos(np.radians(lat2))
+    distance = np.sqrt(x * x + y * y) * ONE_DEGREE_M
+
+    if elevations is not None:
+        elevations = np.asarray(elevations, dtype=np.float64)
+        ele_diff = elevations[1:] - elevations[:-1]
+        has_elevation = ~np.isnan(ele_diff) & (ele_diff != 0)
+        distance = np.where(has_elevation, np.sqrt(distance ** 2 + np.where(has_elevation, ele_diff, 0) ** 2), distance)
+
+    far = (np.abs(x) > .2) | (np.abs(lon2 - lon1) > .2)
+    if far.any():
+        distance[far] = haversine(lat1[far], lon1[far], lat2[far], lon2[far], GPX_EARTH_RADIUS_M)
+
+    distances = np.zeros(len(latitudes))
+    distances[1:] = distance
+    return distances
+
+
+def cumulative_distance(distances):
+    """
+    Sums segment distances into a running total, accumulated in float64
+    """
+    return np.cumsum(distances, dtype=np.float64)
+
+
+def to_local_metres(latitudes, longitudes):
+    """
+    Projects coordinates onto a flat plane in metres around the track's mean latitude.
+    Accurate enough for geometry over the extent of a ride.
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+
+    coef = np.cos(np.radians(np.nanmean(latitudes)))
+    x = (longitudes - longitudes[0]) * coef * ONE_DEGREE_M
+    y = (latitudes - latitudes[0]) * ONE_DEGREE_M
+    return x, y
@@ -0,0 +1,129 @@
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+CHUNK_SIZE = 16384
+
+NAT = np.datetime64('NaT', 'ns').astype(np.int64)
+
+
+class ColumnBuffer:
+    """
+    Collects values into preallocated NumPy chunks and joins them into one array at the end
+    """
+    def __init__(self, dtype, fill, chunk_size=CHUNK_SIZE):
+        self.dtype = dtype
+        self.fill = fill
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.chunk = None
+        self.position = chunk_size
+
+    def append(self, value):
+        if self.position == self.chunk_size:
+            self.chunk = np.full(self.chunk_size, self.fill, dtype=self.dtype)
+            self.chunks.append(self.chunk)
+            self.position = 0
+        if value is not None:
+            self.chunk[self.position] = value
+        self.position += 1
+
+    def __len__(self):
+        return (len(self.chunks) - 1) * self.chunk_size + self.position if self.chunks else 0
+
+    def to_array(self):
+        if not self.chunks:
+            return np.empty(0, dtype=self.dtype)
+        self.chunks[-1] = self.chunks[-1][:self.position]
+        return np.concatenate(self.chunks)
+
+
+def parse_gpx(file, chunk_size=CHUNK_SIZE, max_points=None):
+    """
+    Streams the trackpoints of every track and segment of a GPX file into column arrays,
+    without building the whole XML tree. Takes a file path or a file object.
+    Raises ValueError as soon as the file has more than max_points trackpoints.
+    Returns a dict with 'Time' (datetime64[ns], UTC when the file uses Z times),
+    'Latitude', 'Longitude' and 'Altitude (M)'.
+    """
+    latitudes = ColumnBuffer(np.float64, np.nan, chunk_size)
+    longitudes = ColumnBuffer(np.float64, np.nan, chunk_size)
+    altitudes = ColumnBuffer(np.float64, np.nan, chunk_size)
+    time_strings = []
+    times = []
+
+    segment = None
+    for event, elem in ET.iterparse(file, events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]
+
+        if event == 'start':
+            if tag == 'trkseg':
+                segment = elem
+            continue
+
+        if tag != 'trkpt':
+            continue
+
+        altitude = None
+        time = None
+        for child in elem:
+            child_tag = child.tag.rsplit('}', 1)[-1]
+            if child_tag == 'ele' and child.text:
+                altitude = float(child.text)
+            elif child_tag == 'time' and child.text:
+                time = child.text.strip()
+
+        if max_points is not None and len(latitudes) == max_points:
+            raise ValueError(f'Ride has more than {max_points} points.')
+        latitudes.append(float(elem.get('lat')))
+        longitudes.append(float(elem.get('lon')))
+        altitudes.append(altitude)
+        time_strings.append(time)
+
+        if len(time_strings) == chunk_size:
+            times.append(decode_times(time_strings))
+            time_strings = []
+
+        if segment is not None:
+            segment.clear()
+
+    times.append(decode_times(time_strings))
+    timestamps = np.concatenate([chunk for chunk, _ in times]).view('datetime64[ns]')
+
+    time_column = pd.Series(timestamps)
+    if any(utc for _, utc in times):
+        time_column = time_column.dt.tz_localize('UTC')
+
+    return {
+        'Time': time_column,
+        'Latitude': latitudes.to_array(),
+        'Longitude': longitudes.to_array(),
+        'Altitude (M)': altitudes.to_array(),
+    }
+
+
+def decode_times(time_strings):
+    """
+    Decodes a chunk of ISO-8601 timestamps into int64 nanoseconds since the epoch.
+    Returns (nanoseconds, whether the times are UTC).
+    """
+    values = [time for time in time_strings if time is not None]
+    if not values:
+        return np.full(len(time_strings), NAT, dtype=np.int64), False
+
+    utc = values[0].endswith('Z')
+    naive = [time[:-1] if time.endswith('Z') else time for time in values]
+    try:
+        decoded = np.array(naive, dtype='datetime64[ns]').astype(np.int64)
+    except ValueError:
+        # Offsets like +02:00 are not understood by NumPy
+        decoded = pd.to_datetime(values, utc=True).tz_localize(None).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+        utc = True
+
+    if len(values) == len(time_strings):
+        return decoded, utc
+
+    nanoseconds = np.full(len(time_strings), NAT, dtype=np.int64)
+    nanoseconds[[i for i, time in enumerate(time_strings) if time is not None]] = decoded
+    return nanoseconds, utc
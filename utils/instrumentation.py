@@ -0,0 +1,148 @@
+import bisect
+import re
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """
+    Cumulative Prometheus-style histogram, plus the last window observations for quantiles
+    """
+    def __init__(self, buckets, window=1024):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantiles(self, quantiles=QUANTILES):
+        if not self.recent:
+            return {}
+        return dict(zip(quantiles, np.quantile(np.fromiter(self.recent, dtype=float), quantiles).tolist()))
+
+
+def _token(stage):
+    """
+    Turns a stage name into a Server-Timing metric name
+    """
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', stage).strip('_')
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """
+    Latency and payload size of every stage of a request, kept per process.
+    call() times a stage; the timings of the current request are collected per thread
+    between start_request() and finish_request() for the Server-Timing header, and
+    render() gives every histogram in the Prometheus text format.
+    """
+    def __init__(self, latency_buckets=LATENCY_BUCKETS, size_buckets=SIZE_BUCKETS, window=1024):
+        self.latency_buckets = latency_buckets
+        self.size_buckets = size_buckets
+        self.window = window
+        self.latencies = {}
+        self.payloads = {}
+        self._lock = threading.Lock()
+        self._request = threading.local()
+
+    def observe(self, stage, seconds, payload_bytes=None):
+        """
+        Records one run of a stage, and adds it to the current request's timings
+        """
+        with self._lock:
+            if stage not in self.latencies:
+                self.latencies[stage] = Histogram(self.latency_buckets, self.window)
+            self.latencies[stage].observe(seconds)
+            if payload_bytes is not None:
+                if stage not in self.payloads:
+                    self.payloads[stage] = Histogram(self.size_buckets, self.window)
+                self.payloads[stage].observe(payload_bytes)
+
+        timings = getattr(self._request, 'timings', None)
+        if timings is not None:
+            timings.append((stage, seconds))
+
+    def call(self, stage, function, *args, **kwargs):
+        """
+        Returns function(*args, **kwargs), recording its run time and, for text or bytes
+        results, its size
+        """
+        started = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+
+        payload_bytes = len(result) if isinstance(result, (str, bytes)) else None
+        self.observe(stage, elapsed, payload_bytes)
+        return result
+
+    def start_request(self):
+        self._request.timings = []
+        self._request.started = time.perf_counter()
+
+    def finish_request(self, stage=None):
+        """
+        Ends the current request, recording its total time under stage when given.
+        Returns the Server-Timing header value, or None outside a request.
+        """
+        timings = getattr(self._request, 'timings', None)
+        if timings is None:
+            return None
+        total = time.perf_counter() - self._request.started
+        self._request.timings = None
+        if stage:
+            self.observe(stage, total)
+        entries = [f'{_token(name)};dur={seconds * 1000:.2f}' for name, seconds in timings]
+        entries.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(entries)
+
+    def render(self, prefix='dashboard', counters=()):
+        """
+        Returns every histogram in the Prometheus text exposition format, followed by
+        counters given as (name, help text, value)
+        """
+        with self._lock:
+            lines = []
+            for name, histograms, unit, help_text in (
+                (f'{prefix}_stage_duration_seconds', self.latencies, 'seconds', 'Time spent in each stage.'),
+                (f'{prefix}_stage_payload_bytes', self.payloads, 'bytes', 'Size of the output of each stage.'),
+            ):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for stage, histogram in sorted(histograms.items()):
+                    label = _label(stage)
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{stage="{label}",le="{bound:g}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{stage="{label}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{stage="{label}"}} {histogram.sum:.6g}')
+                    lines.append(f'{name}_count{{stage="{label}"}} {histogram.count}')
+
+                recent = f'{prefix}_stage_recent_{unit}'
+                lines.append(f'# HELP {recent} p50/p95/p99 over the last {self.window} runs of each stage.')
+                lines.append(f'# TYPE {recent} gauge')
+                for stage, histogram in sorted(histograms.items()):
+                    for quantile, value in histogram.quantiles().items():
+                        lines.append(f'{recent}{{stage="{_label(stage)}",quantile="{quantile:g}"}} {value:.6g}')
+
+            for name, help_text, value in counters:
+                lines.append(f'# HELP {prefix}_{name} {help_text}')
+                lines.append(f'# TYPE {prefix}_{name} counter')
+                lines.append(f'{prefix}_{name} {value}')
+            return '\n'.join(lines) + '\n'
@@ -0,0 +1,122 @@
+"""
+Reference datasets rides are compared against: peaks, famous climbs, routes and animal speeds.
+
+Each dataset is a CSV file under DATA_DIR, loaded once per process and sorted on the
+column rides are compared on, so the nearest entry above or below a value is found by
+binary search, for one ride or a whole array of rides at once.
+"""
+import csv
+import os
+import threading
+
+import numpy as np
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+# name -> (file under DATA_DIR, column the entries are compared on)
+DATASETS = {
+    'peaks': ('peaks.csv', 'altitude'),
+    'climbs': ('climbs.csv', 'ascent'),
+    'routes': ('routes.csv', 'distance'),
+    'animals': ('animals.csv', 'speed'),
+}
+
+
+def _number(text):
+    """
+    Parses a CSV value as an int when it is whole, otherwise as a float
+    """
+    value = float(text)
+    return int(value) if value.is_integer() and '.' not in text else value
+
+
+class ReferenceSet:
+    """
+    Entries of a reference dataset sorted by one numeric column.
+    above_indices() and below_indices() find, for an array of values, the entry with the
+    next larger or next smaller value (strictly), -1 where there is none. Entries with the
+    same value keep the order they were given in, and the first of them is returned.
+    """
+    def __init__(self, entries, key):
+        if not entries:
+            raise ValueError('A reference set needs at least one entry.')
+        values = np.array([float(entry[key]) for entry in entries])
+        if np.isnan(values).any():
+            raise ValueError(f"Every entry needs a value for '{key}'.")
+        order = np.argsort(values, kind='stable')
+        self.key = key
+        self.values = values[order]
+        self.entries = [entries[i] for i in order]
+
+    @classmethod
+    def from_csv(cls, path, key):
+        """
+        Loads a CSV file with a header row, parsing the key column as numbers
+        """
+        with open(path, newline='', encoding='utf-8') as csv_file:
+            entries = list(csv.DictReader(csv_file))
+        for line, entry in enumerate(entries, start=2):
+            try:
+                entry[key] = _number(entry[key])
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(f"{path}, line {line}: '{key}' must be a number.") from None
+        return cls(entries, key)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def above_indices(self, values):
+        """
+        Returns the position of the smallest entry larger than each value, -1 where none is
+        """
+        values = np.asarray(values, dtype=float)
+        positions = np.searchsorted(self.values, values, side='right')
+        return np.where((positions < len(self.values)) & ~np.isnan(values), positions, -1)
+
+    def below_indices(self, values):
+        """
+        Returns the position of the largest entry smaller than each value, -1 where none is
+        """
+        values = np.asarray(values, dtype=float)
+        positions = np.searchsorted(self.values, values, side='left') - 1
+        positions[np.isnan(values)] = -1
+        found = positions >= 0
+        # The first of the entries sharing that value
+        positions[found] = np.searchsorted(self.values, self.values[positions[found]], side='left')
+        return positions
+
+    def take(self, indices, field=None):
+        """
+        Returns the entries at indices (or their field), None where the index is -1
+        """
+        return [None if i < 0 else self.entries[i] if field is None else self.entries[i][field] for i in indices]
+
+    def next_above(self, value):
+        """
+        Returns the entry with the next larger value, or None
+        """
+        return self.take(self.above_indices([value]))[0]
+
+    def next_below(self, value):
+        """
+        Returns the entry with the next smaller value, or None
+        """
+        return self.take(self.below_indices([value]))[0]
+
+
+_reference_sets = {}
+_lock = threading.Lock()
+
+def reference_set(name, directory=None):
+    """
+    Returns the named dataset from directory (default DATA_DIR), loading it the first time
+    """
+    if name not in DATASETS:
+        raise ValueError(f"Unknown reference set '{name}'. Use one of: {', '.join(DATASETS)}.")
+    directory = directory or DATA_DIR
+    key = (name, directory)
+    with _lock:
+        if key not in _reference_sets:
+            file_name, column = DATASETS[name]
+            _reference_sets[key] = ReferenceSet.from_csv(os.path.join(directory, file_name), column)
+        return _reference_sets[key]
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from utils import data_preparation
+
+DEFAULT_CHANNELS = ('Segment Speed', 'Altitude (M)')
+
+
+def resample(df, by='time', interval=30, channels=DEFAULT_CHANNELS):
+    """
+    Bins a prepared ride into fixed buckets of interval seconds (by='time') or
+    interval metres (by='distance') in one grouped pass.
+    Channels are averaged weighted by the time each point covers, so irregular
+    recording intervals count correctly. Returns one row per non-empty bucket with
+    the mean 'Total Time (M)' and 'Total Distance (M)' of its points and the
+    weighted average of every channel.
+    """
+    if by == 'time':
+        axis = df['Total Time (M)'].to_numpy(dtype=float) * 60
+    elif by == 'distance':
+        axis = df['Total Distance (M)'].to_numpy(dtype=float)
+    else:
+        raise ValueError("Unsupported resampling axis. Use 'time' or 'distance'.")
+
+    axis = np.nan_to_num(axis)
+    buckets = (axis // interval).astype(np.int64)
+    buckets -= buckets.min() if len(buckets) else 0
+    size = buckets.max() + 1 if len(buckets) else 0
+
+    weights = data_preparation.ride_column(df, 'Time Difference').dt.total_seconds().to_numpy(dtype=float)
+    weights = np.where(np.isnan(weights) | (weights < 0), 0, weights)
+
+    counts = np.bincount(buckets, minlength=size)
+    occupied = counts > 0
+
+    result = {}
+    for column in ['Total Time (M)', 'Total Distance (M)']:
+        values = df[column].to_numpy(dtype=float)
+        present = ~np.isnan(values)
+        totals = np.bincount(buckets[present], weights=values[present], minlength=size)
+        present_counts = np.bincount(buckets[present], minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result[column] = (totals / present_counts)[occupied]
+
+    for column in channels:
+        values = df[column].to_numpy(dtype=float)
+        present = ~np.isnan(values)
+        weighted = np.bincount(buckets[present], weights=values[present] * weights[present], minlength=size)
+        total_weights = np.bincount(buckets[present], weights=weights[present], minlength=size)
+        plain = np.bincount(buckets[present], weights=values[present], minlength=size)
+        present_counts = np.bincount(buckets[present], minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            averages = np.where(total_weights > 0, weighted / total_weights, plain / present_counts)
+        result[column] = averages[occupied]
+
+    return pd.DataFrame(result)
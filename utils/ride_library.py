@@ -0,0 +1,204 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+
+import pandas as pd
+
+from utils import data_preparation, spatial_index
+from utils.batch import find_activity_files
+
+MANIFEST_FILE = '.ride_library.json'
+
+PERIODS = {
+    'week': 'W-SUN',
+    'month': 'M',
+    'year': 'Y',
+}
+
+
+def file_hash(path, chunk_size=1024 ** 2):
+    """
+    Returns the blake2b hash of a file's contents
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as ride_file:
+        for chunk in iter(lambda: ride_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def summarise_ride(df):
+    """
+    Returns the summary kept in the manifest for one prepared ride
+    """
+    summary = data_preparation.ride_summary(df)
+    start = df['Time'].iloc[0]
+    return {
+        'start': start.tz_localize(None).isoformat() if start.tzinfo else start.isoformat(),
+        'distance': float(summary.distance),
+        'total_ascent': float(summary.total_ascent),
+        'moving_seconds': summary.moving_time.total_seconds(),
+    }
+
+
+def _summarise_entry(item):
+    """
+    Parses one file, returning its manifest entry and its simplified track when a
+    tolerance is given
+    """
+    path, entry, tolerance = item
+    track = None
+    try:
+        df = data_preparation.create_prepare_df(path)
+        entry['summary'] = summarise_ride(df)
+        entry.pop('error', None)
+        if tolerance is not None:
+            track = spatial_index.simplify(df, tolerance)
+    except Exception as error:
+        entry['summary'] = None
+        entry['error'] = f'{type(error).__name__}: {error}'
+    return path, entry, track
+
+
+class RideLibrary:
+    """
+    Weekly, monthly and yearly totals over a folder of activity files.
+    Per-ride summaries are kept in a manifest keyed by path, mtime, size and content hash,
+    so update() only parses files that are new or have changed.
+    When given a SpatialIndex, update() keeps it in step with the manifest.
+    update_in_background() runs update() on an executor, so a web request can start a
+    rescan without waiting for it; the totals keep answering from the last manifest.
+    """
+    def __init__(self, directory, manifest_path=None, workers=1, index=None):
+        self.directory = directory
+        self.manifest_path = manifest_path or os.path.join(directory, MANIFEST_FILE)
+        self.workers = workers
+        self.index = index
+        self.scanned = os.path.exists(self.manifest_path)
+        self.rides = self._load_manifest()
+        self._totals = {}
+        self._lock = threading.Lock()
+        self._pending = None
+        self._pending_lock = threading.Lock()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path) as manifest_file:
+                return json.load(manifest_file)['rides']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return {}
+
+    def _save_manifest(self):
+        staging = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(staging, 'w') as manifest_file:
+            json.dump({'rides': self.rides}, manifest_file)
+        os.replace(staging, self.manifest_path)
+
+    def update(self):
+        """
+        Brings the manifest in line with the folder: parses new and changed files and
+        drops removed ones. Returns the number of files parsed.
+        """
+        with self._lock:
+            tolerance = self.index.tolerance if self.index is not None else None
+            rides = {}
+            changed = []
+            for path in find_activity_files(self.directory):
+                key = os.path.relpath(path, self.directory)
+                stat = os.stat(path)
+                entry = self.rides.get(key)
+                unindexed = tolerance is not None and entry and entry.get('summary') and key not in self.index
+                if entry and not unindexed and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                    rides[key] = entry
+                    continue
+
+                content_hash = file_hash(path)
+                if entry and not unindexed and entry['hash'] == content_hash:
+                    rides[key] = dict(entry, mtime=stat.st_mtime, size=stat.st_size)
+                    continue
+                rides[key] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': content_hash}
+                changed.append((path, rides[key], tolerance))
+
+            if self.workers > 1 and len(changed) > 1:
+                with multiprocessing.Pool(self.workers) as pool:
+                    summarised = pool.map(_summarise_entry, changed)
+            else:
+                summarised = [_summarise_entry(item) for item in changed]
+            for path, entry, track in summarised:
+                key = os.path.relpath(path, self.directory)
+                rides[key] = entry
+                if self.index is not None:
+                    if track is not None:
+                        self.index.add_track(key, *track)
+                    else:
+                        self.index.remove(key)
+
+            if self.index is not None:
+                removed = [key for key in self.index.rides if key not in rides]
+                for key in removed:
+                    self.index.remove(key)
+                if changed or removed:
+                    self.index.save()
+
+            if rides != self.rides:
+                # Rides first: totals() takes the cache before reading the rides
+                self.rides = rides
+                self._totals = {}
+                self._save_manifest()
+            self.scanned = True
+            return len(changed)
+
+    def update_in_background(self, executor):
+        """
+        Starts update() on executor unless one is already running, and returns its future
+        """
+        with self._pending_lock:
+            if self._pending is None or self._pending.done():
+                self._pending = executor.submit(self.update)
+            return self._pending
+
+    @property
+    def updating(self):
+        pending = self._pending
+        return pending is not None and not pending.done()
+
+    def summaries(self):
+        """
+        Returns one row per parsed ride with its start, distance (km),
+        total ascent (m) and moving time (s)
+        """
+        rows = [dict(entry['summary'], path=key) for key, entry in self.rides.items() if entry.get('summary')]
+        summaries = pd.DataFrame(rows, columns=['path', 'start', 'distance', 'total_ascent', 'moving_seconds'])
+        summaries['start'] = pd.to_datetime(summaries['start'])
+        return summaries
+
+    def totals(self, period='month'):
+        """
+        Returns the ride count, distance (km), total ascent (m) and moving hours per
+        week, month or year, oldest first
+        """
+        if period not in PERIODS:
+            raise ValueError(f"Unsupported period '{period}'. Use one of: {', '.join(PERIODS)}.")
+        cache = self._totals
+        if period not in cache:
+            summaries = self.summaries()
+            grouped = summaries.groupby(summaries['start'].dt.to_period(PERIODS[period]))
+            totals = grouped.agg(
+                rides=('path', 'size'),
+                distance=('distance', 'sum'),
+                total_ascent=('total_ascent', 'sum'),
+                moving_hours=('moving_seconds', 'sum'),
+            )
+            totals['moving_hours'] /= 3600
+            totals.index = totals.index.start_time.strftime('%Y-%m-%d')
+            totals.index.name = 'period'
+            cache[period] = totals
+        return cache[period]
+
+    def errors(self):
+        """
+        Returns the files that could not be parsed, with their error
+        """
+        return {key: entry['error'] for key, entry in self.rides.items() if entry.get('error')}
@@ -0,0 +1,276 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from utils import data_preparation
+
+META_FILE = 'meta.json'
+CURRENT_FILE = 'current'
+
+# Versions other than the current one older than this are left over and removed
+STALE_SECONDS = 60
+
+
+class RideStore:
+    """
+    Keeps prepared rides on disk as one .npy file per column under directory, keyed by
+    session, so every worker process can load the ride an upload stored.
+    Each put() writes a new version of the ride in its own subdirectory and then swaps
+    the key's pointer file to it, so readers always see a complete ride.
+    Rides are read back memory-mapped, one array per column, so worker processes share
+    the pages of a ride rather than each holding a copy. For a RideFrame only the parsed
+    columns are written, and it is read back as a RideFrame. The last few loaded rides
+    are kept in process.
+    The size of the store is kept as a running total of the rides this process writes
+    and deletes. Once it passes max_bytes, the directory is scanned again (other
+    processes write to it too) and least recently used rides are evicted. A ride larger
+    than max_bytes on its own is refused.
+    """
+    def __init__(self, directory, max_bytes=512 * 1024 ** 2, cached_rides=4):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.cached_rides = cached_rides
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+        self._sizes = {}
+        self._total = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _path(self, key):
+        if not key or not all(c.isalnum() or c in '-_' for c in key):
+            raise ValueError(f"Invalid ride key '{key}'.")
+        return os.path.join(self.directory, key)
+
+    def put(self, key, df):
+        """
+        Stores a prepared ride under key, replacing any ride already stored there
+        """
+        path = self._path(key)
+        lazy = isinstance(df, data_preparation.RideFrame)
+        encoded = [(name, _encode_column(series)) for name, series in (df.base if lazy else df).items()]
+        size = sum(values.nbytes for _, (values, _, _) in encoded)
+        if size > self.max_bytes:
+            raise ValueError(f'Ride takes {size} bytes, more than the {self.max_bytes} bytes the ride store holds.')
+
+        token = uuid.uuid4().hex
+        staging = os.path.join(path, f'{token}.tmp')
+        os.makedirs(staging)
+
+        columns = []
+        for position, (name, (values, kind, tz)) in enumerate(encoded):
+            file_name = f'{position}.npy'
+            np.save(os.path.join(staging, file_name), values)
+            columns.append({'name': name, 'file': file_name, 'kind': kind, 'tz': tz})
+
+        with open(os.path.join(staging, META_FILE), 'w') as meta_file:
+            json.dump({'token': token, 'columns': columns, 'lazy': lazy}, meta_file)
+        os.rename(staging, os.path.join(path, token))
+
+        try:
+            with open(os.path.join(path, CURRENT_FILE)) as pointer_file:
+                previous = pointer_file.read()
+        except FileNotFoundError:
+            previous = None
+        pointer = os.path.join(path, f'{CURRENT_FILE}.{token}.tmp')
+        with open(pointer, 'w') as pointer_file:
+            pointer_file.write(token)
+        os.replace(pointer, os.path.join(path, CURRENT_FILE))
+        self._remove_old_versions(path, token, previous)
+        self._update_size(key, _ride_size(path))
+
+        with self._lock:
+            self._loaded[key] = (token, df)
+            self._loaded.move_to_end(key)
+            self._trim_loaded()
+
+        self.evict(keep=key)
+        return token
+
+    def _remove_old_versions(self, path, current, previous):
+        """
+        Removes the version the pointer held before current, and any other version or
+        unfinished write left for STALE_SECONDS by a put() that lost a race or crashed
+        """
+        stale = time.time() - STALE_SECONDS
+        try:
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.name == current or not entry.is_dir():
+                continue
+            try:
+                if entry.name == previous or entry.stat().st_mtime < stale:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except FileNotFoundError:
+                continue
+
+    def get(self, key):
+        """
+        Returns the ride stored under key, or None if there is none
+        """
+        if not key:
+            return None
+        path = self._path(key)
+
+        # A put() may remove the version just read from the pointer; read it again
+        for _ in range(3):
+            try:
+                with open(os.path.join(path, CURRENT_FILE)) as pointer_file:
+                    token = pointer_file.read()
+                version = os.path.join(path, token)
+                with open(os.path.join(version, META_FILE)) as meta_file:
+                    meta = json.load(meta_file)
+            except FileNotFoundError:
+                continue
+            except json.JSONDecodeError:
+                return None
+
+            with self._lock:
+                cached = self._loaded.get(key)
+                if cached is not None and cached[0] == token:
+                    self._loaded.move_to_end(key)
+                    self._touch(path)
+                    return cached[1]
+
+            try:
+                data = {
+                    column['name']: _decode_column(np.load(os.path.join(version, column['file']), mmap_mode='r'), column['kind'], column['tz'])
+                    for column in meta['columns']
+                }
+            except FileNotFoundError:
+                continue
+            break
+        else:
+            return None
+
+        # copy=False keeps every column its own memory-mapped array instead of
+        # consolidating them into copied blocks
+        df = pd.DataFrame(data, copy=False)
+        if meta.get('lazy'):
+            df = data_preparation.RideFrame(df)
+        self._touch(path)
+
+        with self._lock:
+            self._loaded[key] = (token, df)
+            self._loaded.move_to_end(key)
+            self._trim_loaded()
+        return df
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def delete(self, key):
+        """
+        Removes the ride stored under key
+        """
+        shutil.rmtree(self._path(key), ignore_errors=True)
+        self._update_size(key, 0)
+        with self._lock:
+            self._loaded.pop(key, None)
+
+    def size(self):
+        """
+        Returns the running total of bytes in the store
+        """
+        with self._lock:
+            return self._total
+
+    def _update_size(self, key, size):
+        with self._lock:
+            self._total += size - self._sizes.pop(key, 0)
+            if size:
+                self._sizes[key] = size
+
+    def _scan(self):
+        """
+        Measures every ride in the store, resetting the running total.
+        Returns (last used, size, key) of every ride.
+        """
+        rides = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            try:
+                rides.append((entry.stat().st_mtime, _ride_size(entry.path), entry.name))
+            except FileNotFoundError:
+                continue
+        with self._lock:
+            self._sizes = {key: size for _, size, key in rides}
+            self._total = sum(self._sizes.values())
+        return rides
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used rides, other than keep, until the store fits in max_bytes
+        """
+        if self.size() <= self.max_bytes:
+            return
+
+        rides = self._scan()
+        total = self.size()
+        for _, size, key in sorted(rides):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.delete(key)
+            total -= size
+
+    def _trim_loaded(self):
+        while len(self._loaded) > self.cached_rides:
+            self._loaded.popitem(last=False)
+
+
+def _ride_size(path):
+    """
+    Returns the bytes taken by every version of the ride stored at path
+    """
+    size = 0
+    for version in os.scandir(path):
+        if not version.is_dir():
+            continue
+        # Another process may remove a version while it is measured
+        try:
+            size += sum(file.stat().st_size for file in os.scandir(version.path))
+        except FileNotFoundError:
+            continue
+    return size
+
+
+def _encode_column(series):
+    """
+    Converts a column to a plain NumPy array, returning (values, kind, timezone)
+    """
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        return series.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy(dtype='datetime64[ns]').view(np.int64), 'datetime', str(series.dt.tz)
+    if pd.api.types.is_datetime64_dtype(series.dtype):
+        return series.to_numpy(dtype='datetime64[ns]').view(np.int64), 'datetime', None
+    if pd.api.types.is_timedelta64_dtype(series.dtype):
+        return series.to_numpy(dtype='timedelta64[ns]').view(np.int64), 'timedelta', None
+    if series.dtype == object:
+        return series.astype(str).to_numpy(dtype=str), 'string', None
+    return series.to_numpy(), 'numeric', None
+
+
+def _decode_column(values, kind, tz):
+    """
+    Rebuilds a column stored by _encode_column
+    """
+    if kind == 'datetime':
+        column = pd.Series(np.asarray(values).view('datetime64[ns]'))
+        return column.dt.tz_localize('UTC').dt.tz_convert(tz) if tz else column
+    if kind == 'timedelta':
+        return np.asarray(values).view('timedelta64[ns]')
+    return values
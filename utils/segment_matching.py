@@ -0,0 +1,243 @@
+"""
+Finds every effort on a set of segments across a folder of rides.
+
+    python -m utils.segment_matching RIDES_DIRECTORY SEGMENTS.json --output efforts.csv [--workers N]
+
+SEGMENTS.json is a list of {"name": ..., "points": [[lat, lon], ...]}, the points
+running from the start of the segment to its end.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from utils import data_preparation, geodesy
+from utils.batch import find_activity_files
+
+EFFORT_COLUMNS = ['path', 'segment', 'start_index', 'end_index', 'start_time', 'elapsed_time', 'distance', 'average_speed']
+
+# Largest number of point-to-edge distances computed at once
+_CHUNK_CELLS = 2 ** 20
+
+
+class Segment:
+    """
+    A reference polyline from a start point to an end point, with its bounding box and
+    length in metres precomputed for matching
+    """
+    def __init__(self, name, latitudes, longitudes):
+        self.name = name
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        if len(self.latitudes) < 2:
+            raise ValueError(f"Segment '{name}' needs at least a start and an end point.")
+
+        self.bbox = (self.latitudes.min(), self.longitudes.min(), self.latitudes.max(), self.longitudes.max())
+        self.origin = (self.latitudes[0], self.longitudes[0])
+        self.x, self.y = self.project(self.latitudes, self.longitudes)
+        self.length = float(np.hypot(np.diff(self.x), np.diff(self.y)).sum())
+
+    def project(self, latitudes, longitudes):
+        """
+        Projects coordinates to metres on a flat plane around the start of the segment
+        """
+        lat0, lon0 = self.origin
+        x = (np.asarray(longitudes, dtype=np.float64) - lon0) * np.cos(np.radians(lat0)) * geodesy.ONE_DEGREE_M
+        y = (np.asarray(latitudes, dtype=np.float64) - lat0) * geodesy.ONE_DEGREE_M
+        return x, y
+
+    def overlaps(self, bbox, margin):
+        """
+        Whether the segment's bounding box, grown by margin metres, overlaps bbox
+        """
+        lat_margin = margin / geodesy.ONE_DEGREE_M
+        lon_margin = margin / (geodesy.ONE_DEGREE_M * max(np.cos(np.radians(self.origin[0])), 1e-6))
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        return not (
+            bbox[0] > max_lat + lat_margin or bbox[2] < min_lat - lat_margin
+            or bbox[1] > max_lon + lon_margin or bbox[3] < min_lon - lon_margin
+        )
+
+
+def load_segments(path):
+    """
+    Reads segments from a JSON list of {"name": ..., "points": [[lat, lon], ...]}
+    """
+    with open(path) as segments_file:
+        segments = json.load(segments_file)
+    return [
+        Segment(segment['name'], [point[0] for point in segment['points']], [point[1] for point in segment['points']])
+        for segment in segments
+    ]
+
+
+def distances_to_polyline(px, py, sx, sy):
+    """
+    Returns the distance from every point to the nearest edge of the polyline (sx, sy),
+    in the units of the coordinates
+    """
+    ax, ay = sx[:-1], sy[:-1]
+    dx, dy = np.diff(sx), np.diff(sy)
+    lengths = dx * dx + dy * dy
+    lengths[lengths == 0] = np.inf
+
+    distances = np.empty(len(px))
+    chunk = max(_CHUNK_CELLS // max(len(dx), 1), 1)
+    for start in range(0, len(px), chunk):
+        x = px[start:start + chunk, None] - ax
+        y = py[start:start + chunk, None] - ay
+        t = ((x * dx + y * dy) / lengths).clip(0, 1)
+        distances[start:start + chunk] = np.hypot(x - t * dx, y - t * dy).min(axis=1)
+    return distances
+
+
+def _passes(close):
+    """
+    Splits the indices of the points close to a segment end into separate passes,
+    returning the first and last index of each
+    """
+    indices = np.flatnonzero(close)
+    if len(indices) == 0:
+        return indices, indices
+    breaks = np.flatnonzero(np.diff(indices) > 1)
+    return indices[np.r_[0, breaks + 1]], indices[np.r_[breaks, len(indices) - 1]]
+
+
+def find_efforts(df, segments, tolerance=25.0, min_match=0.95):
+    """
+    Finds every effort on the segments in a prepared ride.
+    An effort starts at the ride's closest point to the segment start and ends at its
+    closest point to the segment end. At least min_match of the ride's points in
+    between must lie within tolerance metres of the segment, and the same share of the
+    segment's points within tolerance metres of the ride.
+    Returns a list of efforts with elapsed time (s), distance (m) and average speed (Km/h).
+    """
+    latitudes = df['Latitude'].to_numpy(dtype=np.float64)
+    longitudes = df['Longitude'].to_numpy(dtype=np.float64)
+    present = ~(np.isnan(latitudes) | np.isnan(longitudes))
+    if not present.any():
+        return []
+    bbox = (latitudes[present].min(), longitudes[present].min(), latitudes[present].max(), longitudes[present].max())
+
+    minutes = df['Total Time (M)'].to_numpy(dtype=np.float64, copy=True)
+    minutes[:1] = np.nan_to_num(minutes[:1])
+    metres = df['Total Distance (M)'].to_numpy(dtype=np.float64)
+    times = df['Time']
+
+    efforts = []
+    for segment in segments:
+        if not segment.overlaps(bbox, tolerance):
+            continue
+
+        x, y = segment.project(latitudes, longitudes)
+        x[~present] = np.inf
+        y[~present] = np.inf
+        to_start = np.hypot(x - segment.x[0], y - segment.y[0])
+        to_end = np.hypot(x - segment.x[-1], y - segment.y[-1])
+        start_firsts, start_lasts = _passes(to_start <= tolerance)
+        end_firsts, end_lasts = _passes(to_end <= tolerance)
+        if len(start_firsts) == 0 or len(end_firsts) == 0:
+            continue
+
+        searched_from = 0
+        for first, last in zip(start_firsts, start_lasts):
+            if first < searched_from:
+                continue
+            start = first + int(np.argmin(to_start[first:last + 1]))
+            following = np.searchsorted(end_firsts, start + 1)
+            if following == len(end_firsts):
+                break
+            end_first, end_last = end_firsts[following], end_lasts[following]
+            end = end_first + int(np.argmin(to_end[end_first:end_last + 1]))
+
+            effort_x, effort_y = x[start:end + 1], y[start:end + 1]
+            on_segment = distances_to_polyline(effort_x, effort_y, segment.x, segment.y) <= tolerance
+            covered = distances_to_polyline(segment.x, segment.y, effort_x, effort_y) <= tolerance
+            if on_segment.mean() < min_match or covered.mean() < min_match:
+                continue
+
+            elapsed = (minutes[end] - minutes[start]) * 60
+            distance = metres[end] - metres[start]
+            efforts.append({
+                'segment': segment.name,
+                'start_index': start,
+                'end_index': end,
+                'start_time': times.iloc[start],
+                'elapsed_time': elapsed,
+                'distance': distance,
+                'average_speed': (distance / 1000) / (elapsed / 3600) if elapsed > 0 else np.nan,
+            })
+            searched_from = end
+    return efforts
+
+
+_worker_segments = {}
+
+def _init_worker(segments, tolerance, min_match):
+    _worker_segments.update(segments=segments, tolerance=tolerance, min_match=min_match)
+
+
+def _match_file(item):
+    path, names = item
+    segments = [segment for segment in _worker_segments['segments'] if names is None or segment.name in names]
+    try:
+        df = data_preparation.create_prepare_df(path)
+    except Exception as error:
+        return path, [], f'{type(error).__name__}: {error}'
+    efforts = find_efforts(df, segments, _worker_segments['tolerance'], _worker_segments['min_match'])
+    return path, efforts, None
+
+
+def match_library(directory, segments, workers=None, index=None, tolerance=25.0, min_match=0.95, log=sys.stderr):
+    """
+    Finds the efforts on every segment across the activity files under directory,
+    parsing each ride once in a process pool.
+    With a SpatialIndex of the folder (keyed by path relative to it), a ride is only
+    parsed when it passes near the start and end of at least one segment.
+    Returns a DataFrame with one row per effort.
+    """
+    paths = find_activity_files(directory)
+    if index is None:
+        work = [(path, None) for path in paths]
+    else:
+        margin = tolerance + index.tolerance
+        candidates = {}
+        for segment in segments:
+            near_start = index.rides_near(segment.latitudes[0], segment.longitudes[0], margin)
+            near_end = index.rides_near(segment.latitudes[-1], segment.longitudes[-1], margin)
+            for ride_id in near_start.keys() & near_end.keys():
+                candidates.setdefault(ride_id, set()).add(segment.name)
+        work = [(path, candidates[key]) for path in paths if (key := os.path.relpath(path, directory)) in candidates]
+
+    rows = []
+    if work:
+        with multiprocessing.Pool(workers, _init_worker, (segments, tolerance, min_match)) as pool:
+            for path, efforts, error in pool.imap_unordered(_match_file, work, chunksize=4):
+                if error:
+                    print(f'{path}: {error}', file=log)
+                rows.extend(dict(effort, path=path) for effort in efforts)
+
+    efforts = pd.DataFrame(rows, columns=EFFORT_COLUMNS)
+    return efforts.sort_values(['segment', 'elapsed_time'], ignore_index=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Find every effort on a set of segments across a folder of rides.')
+    parser.add_argument('directory', help='Directory to search for activity files')
+    parser.add_argument('segments', help='JSON list of {"name": ..., "points": [[lat, lon], ...]}')
+    parser.add_argument('--output', default='efforts.csv', help='CSV of efforts to write')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--tolerance', type=float, default=25.0, help='Metres a ride may stray from a segment')
+    args = parser.parse_args(argv)
+
+    efforts = match_library(args.directory, load_segments(args.segments), args.workers, tolerance=args.tolerance)
+    efforts.to_csv(args.output, index=False)
+    print(f'{len(efforts)} efforts written to {args.output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from utils import geodesy, track_simplification
+
+INDEX_FILE = 'index.json'
+
+# Cell keys pack the integer row and column of a grid cell into one int64
+_OFFSET = 2 ** 24
+_STRIDE = 2 ** 25
+
+
+def simplify(df, tolerance=10.0):
+    """
+    Returns the latitudes and longitudes of a prepared ride's track simplified to tolerance metres
+    """
+    latitudes = df['Latitude'].to_numpy(dtype=float)
+    longitudes = df['Longitude'].to_numpy(dtype=float)
+    present = ~(np.isnan(latitudes) | np.isnan(longitudes))
+    latitudes, longitudes = latitudes[present], longitudes[present]
+
+    kept = track_simplification.douglas_peucker(latitudes, longitudes, tolerance)
+    return latitudes[kept], longitudes[kept]
+
+
+def _segments(latitudes, longitudes):
+    """
+    Returns the start and end points of every segment of a track, a single point
+    counting as a segment of length 0
+    """
+    if len(latitudes) == 1:
+        return latitudes, longitudes, latitudes, longitudes
+    return latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:]
+
+
+def _cell_range(values, cell_size):
+    return np.floor(np.asarray(values, dtype=float) / cell_size).astype(np.int64)
+
+
+def _cells(lat1, lon1, lat2, lon2, cell_size):
+    """
+    Returns the unique keys of the grid cells covered by the bounding boxes of the segments.
+    Segments longer than a cell are split into cell sized pieces first, so a long
+    diagonal covers the cells along it rather than its whole bounding box.
+    """
+    pieces = np.maximum(np.abs(lat2 - lat1), np.abs(lon2 - lon1)) // cell_size + 1
+    if (pieces > 1).any():
+        pieces = pieces.astype(np.int64)
+        segment = np.repeat(np.arange(len(pieces)), pieces)
+        step = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        start = step / pieces[segment]
+        end = (step + 1) / pieces[segment]
+        dlat = lat2 - lat1
+        dlon = lon2 - lon1
+        lat1, lon1, lat2, lon2 = (
+            lat1[segment] + start * dlat[segment], lon1[segment] + start * dlon[segment],
+            lat1[segment] + end * dlat[segment], lon1[segment] + end * dlon[segment],
+        )
+
+    rows_start = _cell_range(np.minimum(lat1, lat2), cell_size)
+    rows_end = _cell_range(np.maximum(lat1, lat2), cell_size)
+    columns_start = _cell_range(np.minimum(lon1, lon2), cell_size)
+    columns_end = _cell_range(np.maximum(lon1, lon2), cell_size)
+
+    heights = rows_end - rows_start + 1
+    widths = columns_end - columns_start + 1
+    counts = heights * widths
+
+    segment = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = rows_start[segment] + offsets // widths[segment]
+    columns = columns_start[segment] + offsets % widths[segment]
+    return np.unique((rows + _OFFSET) * _STRIDE + columns + _OFFSET)
+
+
+def _box_cells(min_lat, min_lon, max_lat, max_lon, cell_size):
+    rows = np.arange(_cell_range(min_lat, cell_size), _cell_range(max_lat, cell_size) + 1)
+    columns = np.arange(_cell_range(min_lon, cell_size), _cell_range(max_lon, cell_size) + 1)
+    return ((rows[:, None] + _OFFSET) * _STRIDE + columns[None, :] + _OFFSET).ravel()
+
+
+def _boxes_overlap(box, other):
+    """
+    Whether two (min_lat, min_lon, max_lat, max_lon) boxes overlap
+    """
+    return box[0] <= other[2] and other[0] <= box[2] and box[1] <= other[3] and other[1] <= box[3]
+
+
+def _segments_cross_box(lat1, lon1, lat2, lon2, min_lat, min_lon, max_lat, max_lon):
+    """
+    Liang-Barsky clipping of every segment against the box at once.
+    Returns whether any segment has a part inside the box.
+    """
+    dx = lon2 - lon1
+    dy = lat2 - lat1
+    enter = np.zeros(len(lat1))
+    leave = np.ones(len(lat1))
+    inside = np.ones(len(lat1), dtype=bool)
+
+    for p, q in ((-dx, lon1 - min_lon), (dx, max_lon - lon1), (-dy, lat1 - min_lat), (dy, max_lat - lat1)):
+        parallel = p == 0
+        inside &= ~(parallel & (q < 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = q / p
+        enter = np.where(~parallel & (p < 0), np.maximum(enter, ratio), enter)
+        leave = np.where(~parallel & (p > 0), np.minimum(leave, ratio), leave)
+
+    return bool((inside & (enter <= leave)).any())
+
+
+def _distance_to_track(lat, lon, latitudes, longitudes):
+    """
+    Returns the distance in metres from a point to the nearest segment of a track
+    """
+    coef = np.cos(np.radians(lat)) * geodesy.ONE_DEGREE_M
+    lat1, lon1, lat2, lon2 = _segments(latitudes, longitudes)
+    x1 = (lon1 - lon) * coef
+    y1 = (lat1 - lat) * geodesy.ONE_DEGREE_M
+    dx = (lon2 - lon1) * coef
+    dy = (lat2 - lat1) * geodesy.ONE_DEGREE_M
+
+    lengths = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(lengths > 0, -(x1 * dx + y1 * dy) / lengths, 0).clip(0, 1)
+    return float(np.hypot(x1 + t * dx, y1 + t * dy).min())
+
+
+class SpatialIndex:
+    """
+    Grid index over the simplified tracks of a library of rides, kept under directory.
+    Every grid cell of cell_size degrees lists the rides with a segment crossing it,
+    so a query only looks at the rides passing through the cells it covers.
+    Rides are added and removed one at a time; save() writes the index listing.
+    """
+    def __init__(self, directory, cell_size=0.01, tolerance=10.0):
+        self.directory = directory
+        self.cell_size = cell_size
+        self.tolerance = tolerance
+        self.rides = {}
+        self._grid = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def __contains__(self, ride_id):
+        return ride_id in self.rides
+
+    def __len__(self):
+        return len(self.rides)
+
+    def _file(self, ride_id):
+        return hashlib.blake2b(ride_id.encode(), digest_size=12).hexdigest() + '.npz'
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE)) as index_file:
+                listing = json.load(index_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+
+        same_grid = listing.get('cell_size') == self.cell_size
+        for ride_id, ride in listing['rides'].items():
+            try:
+                with np.load(os.path.join(self.directory, ride['file'])) as arrays:
+                    latitudes, longitudes = arrays['latitudes'], arrays['longitudes']
+                    cells = arrays['cells'] if same_grid else _cells(*_segments(latitudes, longitudes), self.cell_size)
+            except FileNotFoundError:
+                continue
+            self._insert(ride_id, latitudes, longitudes, cells)
+
+    def _insert(self, ride_id, latitudes, longitudes, cells):
+        self.rides[ride_id] = {
+            'latitudes': latitudes,
+            'longitudes': longitudes,
+            'bbox': (latitudes.min(), longitudes.min(), latitudes.max(), longitudes.max()),
+            'cells': cells,
+        }
+        for cell in cells.tolist():
+            self._grid.setdefault(cell, set()).add(ride_id)
+
+    def add(self, ride_id, df):
+        """
+        Indexes the simplified track of a prepared ride under ride_id
+        """
+        self.add_track(ride_id, *simplify(df, self.tolerance))
+
+    def add_track(self, ride_id, latitudes, longitudes):
+        """
+        Indexes an already simplified track under ride_id, replacing any track indexed there
+        """
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        with self._lock:
+            self._remove(ride_id)
+            if len(latitudes) == 0:
+                return
+            cells = _cells(*_segments(latitudes, longitudes), self.cell_size)
+
+            path = os.path.join(self.directory, self._file(ride_id))
+            staging = f'{path}.{os.getpid()}.tmp.npz'
+            np.savez(staging, latitudes=latitudes, longitudes=longitudes, cells=cells)
+            os.replace(staging, path)
+            self._insert(ride_id, latitudes, longitudes, cells)
+
+    def remove(self, ride_id):
+        """
+        Drops ride_id from the index
+        """
+        with self._lock:
+            self._remove(ride_id)
+
+    def _remove(self, ride_id):
+        ride = self.rides.pop(ride_id, None)
+        if ride is None:
+            return
+        for cell in ride['cells'].tolist():
+            rides = self._grid.get(cell)
+            if rides is not None:
+                rides.discard(ride_id)
+                if not rides:
+                    del self._grid[cell]
+        try:
+            os.remove(os.path.join(self.directory, self._file(ride_id)))
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        """
+        Writes the index listing, making the rides added so far visible to the next load
+        """
+        with self._lock:
+            listing = {
+                'cell_size': self.cell_size,
+                'tolerance': self.tolerance,
+                'rides': {ride_id: {'file': self._file(ride_id)} for ride_id in self.rides},
+            }
+            path = os.path.join(self.directory, INDEX_FILE)
+            staging = f'{path}.{os.getpid()}.tmp'
+            with open(staging, 'w') as index_file:
+                json.dump(listing, index_file)
+            os.replace(staging, path)
+
+    def _candidates(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        Returns (ride id, ride) for the rides listed in the grid cells of the box.
+        A box covering more cells than the grid holds is answered from the rides'
+        bounding boxes instead, so a query never costs more than a pass over the rides.
+        """
+        min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+        min_lon, max_lon = max(min_lon, -180.0), min(max_lon, 180.0)
+        if not (min_lat <= max_lat and min_lon <= max_lon):
+            return []
+
+        rows = int(_cell_range(max_lat, self.cell_size) - _cell_range(min_lat, self.cell_size)) + 1
+        columns = int(_cell_range(max_lon, self.cell_size) - _cell_range(min_lon, self.cell_size)) + 1
+        with self._lock:
+            if rows * columns > len(self._grid):
+                return [
+                    (ride_id, ride) for ride_id, ride in self.rides.items()
+                    if _boxes_overlap(ride['bbox'], (min_lat, min_lon, max_lat, max_lon))
+                ]
+            candidates = set()
+            for cell in _box_cells(min_lat, min_lon, max_lat, max_lon, self.cell_size).tolist():
+                candidates.update(self._grid.get(cell, ()))
+            return [(ride_id, self.rides[ride_id]) for ride_id in candidates]
+
+    def rides_in_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        Returns the sorted ids of the rides whose track passes through the box
+        """
+        matches = []
+        for ride_id, ride in self._candidates(min_lat, min_lon, max_lat, max_lon):
+            if _segments_cross_box(*_segments(ride['latitudes'], ride['longitudes']), min_lat, min_lon, max_lat, max_lon):
+                matches.append(ride_id)
+        return sorted(matches)
+
+    def rides_near(self, lat, lon, radius=200.0):
+        """
+        Returns {ride id: distance in metres} for the rides passing within radius metres
+        of the point, nearest first. Distances are to the simplified tracks, so are
+        accurate to the index tolerance.
+        """
+        lat_margin = radius / geodesy.ONE_DEGREE_M
+        lon_margin = radius / (geodesy.ONE_DEGREE_M * max(np.cos(np.radians(lat)), 1e-6))
+        min_lat, max_lat = lat - lat_margin, lat + lat_margin
+        min_lon, max_lon = lon - lon_margin, lon + lon_margin
+
+        matches = {}
+        for ride_id, ride in self._candidates(min_lat, min_lon, max_lat, max_lon):
+            if not _boxes_overlap(ride['bbox'], (min_lat, min_lon, max_lat, max_lon)):
+                continue
+            distance = _distance_to_track(lat, lon, ride['latitudes'], ride['longitudes'])
+            if distance <= radius:
+                matches[ride_id] = distance
+        return dict(sorted(matches.items(), key=lambda match: match[1]))
@@ -0,0 +1,121 @@
+import numpy as np
+
+from utils import geodesy
+
+START_TIME = np.datetime64('2023-06-04T07:30:00', 's')
+START_POSITION = (51.4545, -2.5879)
+
+
+def generate_ride(points, seed=0, segments=3):
+    """
+    Generates a ride of points trackpoints recorded about once a second.
+    The route wanders with smooth turns over rolling hills, speed drops on climbs, the
+    rider stands still at junctions, positions and altitudes carry GPS noise, the
+    recording skips the odd second, and the ride is split into segments by stops where
+    the recording pauses.
+    Returns a dict of 'Time' (datetime64[s]), 'Latitude', 'Longitude', 'Altitude (M)',
+    'Total Distance (M)', 'Heart Rate (BPM)' and 'Segment' (the segment of every point).
+    """
+    rng = np.random.default_rng(seed)
+
+    intervals = np.where(rng.random(points) < 0.03, rng.integers(2, 6, points), 1)
+    intervals[0] = 0
+
+    segment = np.zeros(points, dtype=np.int64)
+    if segments > 1 and points > segments:
+        stops = np.sort(rng.choice(np.arange(1, points), segments - 1, replace=False))
+        segment[stops] = 1
+        segment = np.cumsum(segment)
+        intervals[stops] += rng.integers(60, 900, segments - 1)
+
+    elapsed = np.cumsum(intervals)
+    times = START_TIME + elapsed.astype('timedelta64[s]')
+
+    progress = elapsed / max(elapsed[-1], 1)
+    hills = 120 + 80 * np.sin(progress * 7 * np.pi) + 25 * np.sin(progress * 41 * np.pi + 1.3)
+    gradient = np.gradient(hills)
+
+    speed = np.clip(27 - 9 * gradient / max(np.abs(gradient).max(), 1e-9) + rng.normal(0, 1.5, points), 4, 60)
+
+    # Traffic lights and junctions: recorded, but standing still
+    stopped = np.zeros(points, dtype=bool)
+    for start in rng.integers(0, points, max(points // 2000, 1)):
+        stopped[start:start + rng.integers(10, 60)] = True
+    speed[stopped] = 0
+    step = speed / 3.6 * intervals
+
+    heading = np.cumsum(rng.normal(0, 0.02, points)) + rng.uniform(0, 2 * np.pi)
+    north = np.cumsum(step * np.cos(heading))
+    east = np.cumsum(step * np.sin(heading))
+
+    latitudes = START_POSITION[0] + north / geodesy.ONE_DEGREE_M
+    longitudes = START_POSITION[1] + east / (geodesy.ONE_DEGREE_M * np.cos(np.radians(START_POSITION[0])))
+    latitudes += rng.normal(0, 3, points) / geodesy.ONE_DEGREE_M
+    longitudes += rng.normal(0, 3, points) / geodesy.ONE_DEGREE_M
+
+    return {
+        'Time': times,
+        'Latitude': np.round(latitudes, 7),
+        'Longitude': np.round(longitudes, 7),
+        'Altitude (M)': np.round(hills + rng.normal(0, 0.5, points), 1),
+        'Total Distance (M)': np.round(np.cumsum(step), 2),
+        'Heart Rate (BPM)': np.clip(np.round(120 + speed * 1.5 + rng.normal(0, 4, points)), 60, 200).astype(np.int64),
+        'Segment': segment,
+    }
+
+
+def _time_strings(times):
+    return np.datetime_as_string(times, unit='s')
+
+
+def write_gpx(ride, path):
+    """
+    Writes a generated ride as a GPX file with one trkseg per segment
+    """
+    times = _time_strings(ride['Time'])
+    latitudes, longitudes, altitudes, segment = ride['Latitude'], ride['Longitude'], ride['Altitude (M)'], ride['Segment']
+
+    with open(path, 'w', encoding='utf-8') as gpx_file:
+        gpx_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        gpx_file.write('<gpx version="1.1" creator="synthetic" xmlns="http://www.topografix.com/GPX/1/1">\n')
+        gpx_file.write(' <trk>\n  <name>Synthetic ride</name>\n  <trkseg>\n')
+        for i in range(len(times)):
+            if i and segment[i] != segment[i - 1]:
+                gpx_file.write('  </trkseg>\n  <trkseg>\n')
+            gpx_file.write(
+                f'   <trkpt lat="{latitudes[i]}" lon="{longitudes[i]}"><ele>{altitudes[i]}</ele>'
+                f'<time>{times[i]}Z</time></trkpt>\n'
+            )
+        gpx_file.write('  </trkseg>\n </trk>\n</gpx>\n')
+
+
+def write_tcx(ride, path):
+    """
+    Writes a generated ride as a TCX file with one Lap per segment
+    """
+    times = _time_strings(ride['Time'])
+    latitudes, longitudes, altitudes = ride['Latitude'], ride['Longitude'], ride['Altitude (M)']
+    distances, heart_rates, segment = ride['Total Distance (M)'], ride['Heart Rate (BPM)'], ride['Segment']
+
+    with open(path, 'w', encoding='utf-8') as tcx_file:
+        tcx_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        tcx_file.write('<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">\n')
+        tcx_file.write(f' <Activities>\n  <Activity Sport="Biking">\n   <Id>{times[0]}Z</Id>\n')
+        for i in range(len(times)):
+            if i == 0 or segment[i] != segment[i - 1]:
+                if i:
+                    tcx_file.write('     </Track>\n   </Lap>\n')
+                tcx_file.write(f'   <Lap StartTime="{times[i]}Z">\n     <Track>\n')
+            tcx_file.write(
+                f'      <Trackpoint><Time>{times[i]}Z</Time>'
+                f'<Position><LatitudeDegrees>{latitudes[i]}</LatitudeDegrees><LongitudeDegrees>{longitudes[i]}</LongitudeDegrees></Position>'
+                f'<AltitudeMeters>{altitudes[i]}</AltitudeMeters><DistanceMeters>{distances[i]}</DistanceMeters>'
+                f'<HeartRateBpm><Value>{heart_rates[i]}</Value></HeartRateBpm></Trackpoint>\n'
+            )
+        tcx_file.write('     </Track>\n   </Lap>\n  </Activity>\n </Activities>\n</TrainingCenterDatabase>\n')
+
+
+WRITERS = {
+    'gpx': write_gpx,
+    'tcx': write_tcx,
+}
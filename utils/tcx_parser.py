@@ -0,0 +1,106 @@
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+from utils.gpx_parser import CHUNK_SIZE, ColumnBuffer, decode_times
+
+# Local tag name inside a Trackpoint -> column
+TRACKPOINT_FIELDS = {
+    'LatitudeDegrees': 'Latitude',
+    'LongitudeDegrees': 'Longitude',
+    'AltitudeMeters': 'Altitude (M)',
+    'DistanceMeters': 'Total Distance (M)',
+    'Value': 'Heart Rate (BPM)',
+    'Cadence': 'Cadence (RPM)',
+    'Watts': 'Power (W)',
+}
+
+COLUMNS = ['Latitude', 'Longitude', 'Altitude (M)', 'Total Distance (M)']
+OPTIONAL_COLUMNS = ['Heart Rate (BPM)', 'Cadence (RPM)', 'Power (W)']
+
+
+def parse_tcx(file, chunk_size=CHUNK_SIZE, max_points=None):
+    """
+    Streams the trackpoints of a TCX file into column arrays in a single pass.
+    Takes a file path or a file object. Missing fields are NaN. Raises ValueError as
+    soon as the file has more than max_points trackpoints. Returns a dict with
+    'Time', 'Latitude', 'Longitude', 'Altitude (M)', 'Total Distance (M)', any of
+    'Heart Rate (BPM)', 'Cadence (RPM)' and 'Power (W)' that were recorded, and
+    'Lap', the index of the lap each trackpoint belongs to.
+    """
+    buffers = {column: ColumnBuffer(np.float64, np.nan, chunk_size) for column in COLUMNS + OPTIONAL_COLUMNS}
+    laps = ColumnBuffer(np.int32, -1, chunk_size)
+    slots = {}
+    time_strings = []
+    times = []
+
+    lap = -1
+    track = None
+    for event, elem in ET.iterparse(file, events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]
+
+        if event == 'start':
+            if tag == 'Lap':
+                lap += 1
+            elif tag == 'Track':
+                track = elem
+            continue
+
+        if tag != 'Trackpoint':
+            continue
+
+        values = dict.fromkeys(buffers)
+        time = None
+        for child in elem.iter():
+            if child.tag not in slots:
+                slots[child.tag] = _slot(child.tag)
+            slot = slots[child.tag]
+            if slot is None or not child.text:
+                continue
+            if slot == 'Time':
+                time = child.text.strip()
+            else:
+                values[slot] = float(child.text)
+
+        if max_points is not None and len(laps) == max_points:
+            raise ValueError(f'Ride has more than {max_points} points.')
+        for column, buffer in buffers.items():
+            buffer.append(values[column])
+        laps.append(max(lap, 0))
+        time_strings.append(time)
+
+        if len(time_strings) == chunk_size:
+            times.append(decode_times(time_strings))
+            time_strings = []
+
+        if track is not None:
+            track.clear()
+
+    times.append(decode_times(time_strings))
+    timestamps = np.concatenate([chunk for chunk, _ in times]).view('datetime64[ns]')
+
+    time_column = pd.Series(timestamps)
+    if any(utc for _, utc in times):
+        time_column = time_column.dt.tz_localize('UTC')
+
+    result = {'Time': time_column}
+    for column in COLUMNS:
+        result[column] = buffers[column].to_array()
+    for column in OPTIONAL_COLUMNS:
+        values = buffers[column].to_array()
+        if not np.isnan(values).all():
+            result[column] = values
+    result['Lap'] = laps.to_array()
+
+    return result
+
+
+def _slot(tag):
+    """
+    Resolves a namespaced tag to the column it fills, once per distinct tag
+    """
+    local = tag.rsplit('}', 1)[-1]
+    if local == 'Time':
+        return 'Time'
+    return TRACKPOINT_FIELDS.get(local)
@@ -0,0 +1,141 @@
+import json
+
+import numpy as np
+
+from utils import data_preparation, track_simplification
+
+
+def track_vertices(df, tolerance=5.0, marker_budget=300):
+    """
+    Picks the vertices sent to the client: the simplified line plus the tooltip markers,
+    leaving out points without a position. Altitude and speed key points are only added
+    when the ride has them.
+    Returns (vertex indices, positions of the markers within the vertices).
+    """
+    latitudes = df['Latitude'].to_numpy(dtype=float)
+    longitudes = df['Longitude'].to_numpy(dtype=float)
+    altitudes = df['Altitude (M)'].to_numpy(dtype=float)
+
+    located = np.isfinite(latitudes) & np.isfinite(longitudes)
+    if not located.any():
+        return np.arange(0), np.arange(0)
+    positions = np.flatnonzero(located)
+
+    route = positions[track_simplification.douglas_peucker(latitudes[positions], longitudes[positions], tolerance)]
+    key_points = [data_preparation.ride_summary(df).fastest_index]
+    if np.isfinite(altitudes[positions]).any():
+        key_points.append(int(positions[np.nanargmax(altitudes[positions])]))
+    key_points = [index for index in key_points if index is not None]
+    markers = track_simplification.marker_indices(df['Total Distance (M)'], marker_budget, key_points)
+    markers = markers[located[markers]]
+
+    vertices = np.union1d(route, markers)
+    return vertices, np.searchsorted(vertices, markers)
+
+
+def _vertex_properties(df, vertices):
+    return {
+        'distance': np.round(np.nan_to_num(df['Total Distance (M)'].to_numpy(dtype=float)[vertices]), 1),
+        'altitude': np.round(df['Altitude (M)'].to_numpy(dtype=float)[vertices], 1),
+        'time': np.round(np.nan_to_num(df['Total Time (M)'].to_numpy(dtype=float)[vertices]), 2),
+    }
+
+
+def track_geojson(df, tolerance=5.0, marker_budget=300):
+    """
+    Returns the ride as a GeoJSON Feature string. The LineString has [lon, lat, altitude]
+    coordinates ([lon, lat] where the altitude is missing), with per-vertex distance (m)
+    and time (min) arrays in its properties. A ride without positions gives an empty
+    FeatureCollection.
+    """
+    vertices, markers = track_vertices(df, tolerance, marker_budget)
+    if len(vertices) == 0:
+        return json.dumps({'type': 'FeatureCollection', 'features': []}, separators=(',', ':'))
+    properties = _vertex_properties(df, vertices)
+
+    longitudes = np.round(df['Longitude'].to_numpy(dtype=float)[vertices], 6).tolist()
+    latitudes = np.round(df['Latitude'].to_numpy(dtype=float)[vertices], 6).tolist()
+    altitudes = properties['altitude'].tolist()
+    coordinates = [[lon, lat] if np.isnan(alt) else [lon, lat, alt] for lon, lat, alt in zip(longitudes, latitudes, altitudes)]
+
+    feature = {
+        'type': 'Feature',
+        'geometry': {'type': 'LineString', 'coordinates': coordinates},
+        'properties': {
+            'distance': properties['distance'].tolist(),
+            'time': properties['time'].tolist(),
+            'markers': markers.tolist(),
+        },
+    }
+    return json.dumps(feature, separators=(',', ':'), allow_nan=False)
+
+
+def track_polyline(df, tolerance=5.0, marker_budget=300):
+    """
+    Returns the ride as a JSON string holding an encoded polyline of the route,
+    and encoded per-vertex distance (m), altitude (m) and time (min) series.
+    Gaps in the altitude are interpolated, and altitude is null when the ride has none.
+    """
+    vertices, markers = track_vertices(df, tolerance, marker_budget)
+    properties = _vertex_properties(df, vertices)
+
+    latitudes = df['Latitude'].to_numpy(dtype=float)[vertices]
+    longitudes = df['Longitude'].to_numpy(dtype=float)[vertices]
+
+    altitudes = properties['altitude']
+    recorded = np.isfinite(altitudes)
+    if recorded.any():
+        altitudes = np.interp(np.arange(len(altitudes)), np.flatnonzero(recorded), altitudes[recorded])
+
+    payload = {
+        'polyline': encode_polyline(latitudes, longitudes),
+        'distance': encode_series(properties['distance'], 1),
+        'altitude': encode_series(altitudes, 1) if recorded.any() else None,
+        'time': encode_series(properties['time'], 2),
+        'markers': markers.tolist(),
+    }
+    return json.dumps(payload, separators=(',', ':'), allow_nan=False)
+
+
+def encode_polyline(latitudes, longitudes, precision=5):
+    """
+    Encodes coordinates in the encoded polyline format, interleaving latitude and longitude
+    """
+    scale = 10 ** precision
+    values = np.column_stack((
+        _deltas(np.round(np.asarray(latitudes, dtype=float) * scale)),
+        _deltas(np.round(np.asarray(longitudes, dtype=float) * scale)),
+    )).ravel()
+    return _encode_values(values)
+
+
+def encode_series(values, precision):
+    """
+    Encodes a single numeric series with the polyline delta encoding
+    """
+    scale = 10 ** precision
+    return _encode_values(_deltas(np.round(np.asarray(values, dtype=float) * scale)))
+
+
+def _deltas(values):
+    values = values.astype(np.int64)
+    return np.diff(values, prepend=0)
+
+
+def _encode_values(values):
+    """
+    Zigzag and base64-like 5 bit chunk encoding of signed integers, vectorized over all values
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) == 0:
+        return ''
+    zigzag = np.where(values < 0, ~(values << 1), values << 1).astype(np.uint64)
+
+    shifts = np.arange(0, 60, 5, dtype=np.uint64)
+    chunks = (zigzag[:, None] >> shifts) & np.uint64(0x1F)
+    remaining = zigzag[:, None] >> (shifts + np.uint64(5))
+    used = np.concatenate((np.ones((len(values), 1), dtype=bool), (zigzag[:, None] >> shifts)[:, 1:] > 0), axis=1)
+
+    characters = chunks | np.where(remaining > 0, np.uint64(0x20), np.uint64(0))
+    characters = (characters + np.uint64(63)).astype(np.uint8)
+    return characters[used].tobytes().decode('ascii')
@@ -0,0 +1,59 @@
+import numpy as np
+
+from utils import geodesy
+
+
+def douglas_peucker(latitudes, longitudes, tolerance=5.0):
+    """
+    Simplifies a track with the Douglas-Peucker algorithm, keeping every point
+    further than tolerance metres from the simplified line.
+    Returns the sorted indices of the points kept.
+    """
+    n = len(latitudes)
+    if n < 3:
+        return np.arange(n)
+
+    x, y = geodesy.to_local_metres(latitudes, longitudes)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        dx = x[end] - x[start]
+        dy = y[end] - y[start]
+        px = x[start + 1:end] - x[start]
+        py = y[start + 1:end] - y[start]
+
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(px * dy - py * dx) / length
+
+        furthest = np.argmax(distances)
+        if distances[furthest] > tolerance:
+            middle = start + 1 + furthest
+            keep[middle] = True
+            stack.append((start, middle))
+            stack.append((middle, end))
+
+    return np.flatnonzero(keep)
+
+
+def marker_indices(distances, budget=300, key_points=()):
+    """
+    Picks at most budget points spread evenly by distance, plus the key points given.
+    Returns the sorted, unique indices.
+    """
+    distances = np.fmax.accumulate(np.nan_to_num(np.asarray(distances, dtype=np.float64)))
+    if len(distances) == 0:
+        return np.arange(0)
+
+    targets = np.linspace(distances[0], distances[-1], max(budget, 2))
+    indices = np.searchsorted(distances, targets, side='left').clip(0, len(distances) - 1)
+    key_points = [index for index in key_points if index is not None]
+    return np.unique(np.concatenate((indices, np.asarray(key_points, dtype=np.int64))))
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import data_preparation
+
+FINISHED = ('done', 'error')
+
+
+class UploadQueueFull(Exception):
+    """
+    Raised when an upload arrives while max_pending uploads are already queued or running
+    """
+
+
+class ProgressFile:
+    """
+    Read-only file wrapper that reports the share of the file read so far to callback.
+    Has the filename attribute create_df uses to pick the parser.
+    """
+    def __init__(self, path, filename, callback):
+        self.filename = filename
+        self.size = os.path.getsize(path) or 1
+        self.position = 0
+        self.callback = callback
+        self._file = open(path, 'rb')
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.position += len(data)
+        self.callback(self.position / self.size)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class UploadJobs:
+    """
+    Parses and prepares uploaded rides on a background thread pool and puts them in the
+    ride store. Job status is kept as a JSON file per job under directory, so any worker
+    process can report on it. At most max_pending uploads are queued or running at once.
+    Parsing aborts once a ride has more than max_points points or max_bytes of
+    uncompressed data. Each step is timed into metrics when given.
+    """
+    def __init__(self, directory, store, workers=2, max_pending=8, max_points=None, max_bytes=None, status_interval=0.25, max_age=3600, metrics=None):
+        self.directory = directory
+        self.store = store
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self.status_interval = status_interval
+        self.max_age = max_age
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='upload')
+        os.makedirs(directory, exist_ok=True)
+
+    def _status_path(self, job_id):
+        if not job_id or not job_id.isalnum():
+            raise ValueError(f"Invalid job id '{job_id}'.")
+        return os.path.join(self.directory, f'{job_id}.json')
+
+    def _write_status(self, job_id, **status):
+        path = self._status_path(job_id)
+        staging = f'{path}.{threading.get_ident()}.tmp'
+        with open(staging, 'w') as status_file:
+            json.dump(dict(status, updated=time.time()), status_file)
+        os.replace(staging, path)
+
+    def submit(self, upload, ride_key):
+        """
+        Saves an uploaded file and queues it to be stored under ride_key.
+        Returns the job id, or raises UploadQueueFull.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise UploadQueueFull('Too many uploads are being processed. Try again shortly.')
+        try:
+            self.prune()
+            job_id = uuid.uuid4().hex
+            path = os.path.join(self.directory, f'{job_id}.upload')
+            upload.save(path)
+            self._write_status(job_id, state='queued', progress=0.0, error=None)
+            self._executor.submit(self._run, job_id, path, upload.filename, ride_key)
+        except BaseException:
+            self._slots.release()
+            raise
+        return job_id
+
+    def _call(self, stage, function, *args):
+        if self.metrics is None:
+            return function(*args)
+        return self.metrics.call(stage, function, *args)
+
+    def _run(self, job_id, path, filename, ride_key):
+        last_report = 0.0
+
+        def report_parsing(share):
+            nonlocal last_report
+            now = time.monotonic()
+            if now - last_report >= self.status_interval:
+                last_report = now
+                self._write_status(job_id, state='parsing', progress=round(0.8 * share, 3), error=None)
+
+        try:
+            self._write_status(job_id, state='parsing', progress=0.0, error=None)
+            upload = ProgressFile(path, filename, report_parsing)
+            try:
+                df = self._call('create_df', data_preparation.create_df, upload, self.max_points, self.max_bytes)
+            finally:
+                upload.close()
+
+            self._write_status(job_id, state='preparing', progress=0.8, error=None)
+            df = self._call('prepare_df', data_preparation.prepare_df, df)
+
+            self._write_status(job_id, state='storing', progress=0.9, error=None)
+            self._call('store_ride', self.store.put, ride_key, df)
+            self._write_status(job_id, state='done', progress=1.0, error=None)
+        except Exception as error:
+            self._write_status(job_id, state='error', progress=1.0, error=f'{type(error).__name__}: {error}')
+        finally:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._slots.release()
+
+    def status(self, job_id):
+        """
+        Returns the status of a job: its state (queued, parsing, preparing, storing,
+        done or error), progress from 0 to 1 and error message. None if unknown.
+        """
+        try:
+            with open(self._status_path(job_id)) as status_file:
+                return json.load(status_file)
+        except (ValueError, FileNotFoundError):
+            return None
+
+    def wait(self, job_id, timeout):
+        """
+        Polls a job until it finishes or timeout seconds pass, returning its last status
+        """
+        deadline = time.monotonic() + timeout
+        status = self.status(job_id)
+        while status is not None and status['state'] not in FINISHED and time.monotonic() < deadline:
+            time.sleep(0.05)
+            status = self.status(job_id)
+        return status
+
+    def prune(self):
+        """
+        Removes the status files of jobs last updated more than max_age seconds ago
+        """
+        cutoff = time.time() - self.max_age
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass